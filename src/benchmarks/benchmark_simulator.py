@@ -0,0 +1,216 @@
+from src.utilities import config
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import subprocess
+import platform
+import datetime
+import json
+import time
+import os
+
+"""
+This file contains the benchmark of the simulator: a fixed set of scenarios is run for a fixed number of steps,
+every scenario in a fresh process, and the throughput, the memory and the time spent in every phase of
+Simulator.run (see src.simulation.profiler) are saved as json in config.BENCHMARKS_DIR.
+Comparing the files of two commits shows the regressions.
+
+    python -m src.benchmarks.benchmark_simulator -st 2000
+    python -m src.benchmarks.benchmark_simulator -sc QL_50_GAUSSIAN QL-NOSW_50_GAUSSIAN -cmp old.json
+
+Tours are generated from the seed (config.PATH_FROM_JSON = False), the tours json has too few drones.
+"""
+
+# the scenarios: (routing algorithm, stepwise node discovery, number of drones, channel error)
+ALGORITHMS = [("GEO", False), ("RND", False), ("QL", True), ("QL", False)]
+DRONES_NUMBERS = [5, 50, 200]
+CHANNEL_ERRORS = ["GAUSSIAN", "UNIFORM"]
+
+DEFAULT_STEPS = 2000
+DEFAULT_SEED = 1
+
+
+def scenario_name(algorithm, stepwise, n_drones, channel_error):
+    """ e.g. QL_50_GAUSSIAN, QL-NOSW_50_GAUSSIAN when the stepwise node discovery is off """
+    suffix = "-NOSW" if algorithm == "QL" and not stepwise else ""
+    return algorithm + suffix + "_" + str(n_drones) + "_" + channel_error
+
+
+SCENARIOS = {scenario_name(algorithm, stepwise, n_drones, channel_error): (algorithm, stepwise, n_drones,
+                                                                           channel_error)
+             for algorithm, stepwise in ALGORITHMS
+             for n_drones in DRONES_NUMBERS
+             for channel_error in CHANNEL_ERRORS}
+
+
+def peak_rss_mb():
+    """ the peak resident set size of this process in MB, None where the resource module is missing """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak / 2 ** 20 if platform.system() == "Darwin" else peak / 2 ** 10
+
+
+def sample_medium_queue(simulation):
+    """ the packets waiting in the medium, sampled at every step before the delivery """
+    queue_lengths = []
+    dispatcher = simulation.network_dispatcher
+    run_medium = dispatcher.run_medium
+
+    def sampled_run_medium(current_ts):
+        queue_lengths.append(len(dispatcher))
+        return run_medium(current_ts)
+
+    dispatcher.run_medium = sampled_run_medium
+    return queue_lengths
+
+
+def run_scenario(name, n_steps, seed):
+    """
+    Run a single scenario, it is the job executed in a fresh process for every scenario
+    @param name: the name of the scenario, a key of SCENARIOS
+    @param n_steps: the number of steps of the simulation
+    @param seed: the simulation seed
+    @return: a dictionary with the measures of the run
+    """
+    from src.simulation.simulator import Simulator
+
+    algorithm, stepwise, n_drones, channel_error = SCENARIOS[name]
+
+    config.PATH_FROM_JSON = False
+    config.STEPWISE_NODE_DISCOVERY = stepwise
+    config.PLOT_SIM = False
+    config.SAVE_PLOT = False
+
+    start = time.perf_counter()
+    simulation = Simulator(len_simulation=n_steps,
+                           seed=seed,
+                           n_drones=n_drones,
+                           routing_algorithm=config.RoutingAlgorithm[algorithm],
+                           communication_error_type=config.ChannelError[channel_error],
+                           show_plot=False,
+                           profile_phases=True)
+    setup_seconds = time.perf_counter() - start
+    setup_rss = peak_rss_mb()
+
+    queue_lengths = sample_medium_queue(simulation)
+    start = time.perf_counter()
+    simulation.run()
+    run_seconds = time.perf_counter() - start
+
+    profile = simulation.profiler.summary()
+    step_phases = [name for name in profile if not name.startswith("routing.")]
+    return {
+        "algorithm": algorithm,
+        "stepwise_node_discovery": stepwise,
+        "n_drones": n_drones,
+        "channel_error": channel_error,
+        "steps": n_steps,
+        "setup_seconds": setup_seconds,
+        "run_seconds": run_seconds,
+        "steps_per_second": n_steps / run_seconds,
+        "peak_rss_mb_after_setup": setup_rss,
+        "peak_rss_mb": peak_rss_mb(),
+        "mean_medium_queue_length": sum(queue_lengths) / max(1, len(queue_lengths)),
+        "max_medium_queue_length": max(queue_lengths, default=0),
+        "phases": profile,
+        "phase_seconds_other": run_seconds - sum(profile[name]["seconds"] for name in step_phases),
+    }
+
+
+def git_commit():
+    """ the current commit and whether the tracked files were modified, (None, None) outside of git """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True)
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit.stdout.strip(), len(status.stdout.strip()) > 0
+
+
+def run_benchmark(names, n_steps=DEFAULT_STEPS, seed=DEFAULT_SEED):
+    """
+    Run the scenarios one after the other, each one in a fresh process so that the peak memory and the
+    module level config of a scenario do not leak in the next one
+    @param names: the names of the scenarios to run
+    @param n_steps: the number of steps of every simulation
+    @param seed: the simulation seed
+    @return: the results, a dictionary with the environment of the run and the measures of every scenario
+    """
+    commit, dirty = git_commit()
+    results = {
+        "commit": commit,
+        "dirty": dirty,
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "steps": n_steps,
+        "seed": seed,
+        "scenarios": {},
+    }
+
+    for name in names:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            scenario = pool.submit(run_scenario, name, n_steps, seed).result()
+
+        results["scenarios"][name] = scenario
+        print(f"{name}: {scenario['steps_per_second']:.1f} steps/s, "
+              f"peak rss {scenario['peak_rss_mb'] or float('nan'):.1f} MB, "
+              f"medium queue {scenario['mean_medium_queue_length']:.1f}")
+
+    return results
+
+
+def compare_results(old_results, new_results):
+    """ print the speedup of the new results over the old ones, for the scenarios in both """
+    print(f"{old_results['commit']} -> {new_results['commit']}")
+    for name, new_scenario in new_results["scenarios"].items():
+        old_scenario = old_results["scenarios"].get(name)
+        if old_scenario is None or old_scenario["steps"] != new_scenario["steps"]:
+            continue
+        speedup = new_scenario["steps_per_second"] / old_scenario["steps_per_second"]
+        print(f"{name}: {old_scenario['steps_per_second']:.1f} -> {new_scenario['steps_per_second']:.1f} "
+              f"steps/s (x{speedup:.2f})")
+
+
+command_line_parser = ArgumentParser()
+
+command_line_parser.add_argument("-sc", dest="scenarios", action="store", type=str, nargs="+",
+                                 choices=list(SCENARIOS), default=list(SCENARIOS),
+                                 help="the scenarios to run, all of them by default")
+command_line_parser.add_argument("-st", dest="steps", action="store", type=int, default=DEFAULT_STEPS,
+                                 help="the number of steps of every simulation")
+command_line_parser.add_argument("-s", dest="seed", action="store", type=int, default=DEFAULT_SEED,
+                                 help="the simulation seed")
+command_line_parser.add_argument("-o", dest="output", action="store", type=str, default=None,
+                                 help="the json file of the results, by default in config.BENCHMARKS_DIR")
+command_line_parser.add_argument("-cmp", dest="compare", action="store", type=str, default=None,
+                                 help="a json file of previous results, to compare with")
+
+
+if __name__ == "__main__":
+
+    args = command_line_parser.parse_args()
+
+    # no progress bars in the spawned processes
+    os.environ.setdefault("TQDM_DISABLE", "1")
+
+    benchmark = run_benchmark(args.scenarios, args.steps, args.seed)
+
+    output = args.output
+    if output is None:
+        os.makedirs(config.BENCHMARKS_DIR, exist_ok=True)
+        output = (config.BENCHMARKS_DIR + "bench_" + (benchmark["commit"] or "nogit")[:8] + "_"
+                  + benchmark["date"].replace(":", "-") + ".json")
+
+    with open(output, "w") as output_file:
+        json.dump(benchmark, output_file, indent=2)
+    print("Results saved in " + output)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as compare_file:
+            compare_results(json.load(compare_file), benchmark)
@@ -1,4 +1,6 @@
 import numpy as np
+import threading
+import heapq
 
 from src.utilities import config, utilities
 
@@ -8,6 +10,8 @@ class SimulatedEntity:
     of the simulation. No class of this type is directly instantiable.
     """
 
+    __slots__ = ("simulator",)
+
     def __init__(self, simulator):
         self.simulator = simulator
 
@@ -16,6 +20,8 @@ class SimulatedEntity:
 class Entity(SimulatedEntity):
     """ An entity in the environment, e.g. Drone, Event, Packet. It extends SimulatedEntity. """
 
+    __slots__ = ("identifier", "coords")
+
     def __init__(self, identifier: int, coords: tuple, simulator):
         super().__init__(simulator)
         self.identifier = identifier  # the id of the entity
@@ -37,8 +43,10 @@ class Entity(SimulatedEntity):
 class Event(Entity):
     """ An event is any kind of event that the drone detects on the aoi. It is an Entity. """
 
+    __slots__ = ("current_time", "discovery_packet_event", "deadline")
+
     def __init__(self, coords: tuple, current_time: int, simulator, deadline=None, discovery_packet_event=False):
-        super().__init__(id(self), coords, simulator)
+        super().__init__(next(simulator.entity_ids), coords, simulator)
         self.current_time = current_time
         self.discovery_packet_event = discovery_packet_event
         
@@ -53,7 +61,7 @@ class Event(Entity):
         # add metrics: all the events generated during the simulation
         # GENERATED_EVENTS
         if not coords == (-1, -1) and not current_time == -1:
-            self.simulator.metrics.events.add(self)
+            self.simulator.metrics.record_event(self)
 
     def to_json(self):
         """ return the json repr of the obj """
@@ -91,16 +99,18 @@ class Event(Entity):
 class Packet(Entity):
     """ A packet is an object created out of an event monitored on the aoi. """
 
+    __slots__ = ("time_step_creation", "event_ref", "__TTL", "__max_TTL", "number_retransmission_attempt",
+                 "last_2_hops", "metrics_row", "optional_data", "time_delivery", "is_move_packet")
+
     def __init__(self, time_step_creation, simulator, event_ref: Event = None, discovery_packet=False):
         """ the event associated to the packet, time step in which the packet was created
          as for now, every packet is an event. """
 
-        event_ref_crafted = event_ref if event_ref is not None else Event((-1, -1), -1,
-                                                                          simulator)  # default event if packet is not associated to the event
+        # the packets not associated to an event share the placeholder event of the simulation
+        event_ref_crafted = event_ref if event_ref is not None else simulator.no_event
 
-        # id(self) is the id of this instance (unique for every new created packet),
-        # the coordinates are those of the event
-        super().__init__(id(self), event_ref_crafted.coords, simulator)
+        # the id is unique for every new created packet, the coordinates are those of the event
+        super().__init__(next(simulator.entity_ids), event_ref_crafted.coords, simulator)
 
         self.time_step_creation = time_step_creation
         self.event_ref = event_ref_crafted
@@ -114,10 +124,11 @@ class Packet(Entity):
         self.number_retransmission_attempt = 0
 
         # self.hops = set()  # All the drones that have received/transmitted the packets
-        self.last_2_hops = []
+        self.last_2_hops = ()
         # add metrics: all the packets generated by the drones, either delivered or not (union of all the buffers)
+        self.metrics_row = None  # the row of the packet when the metrics are streamed
         if event_ref is not None:
-            self.add = self.simulator.metrics.drones_packets.add(self)
+            self.metrics_row = self.simulator.metrics.record_packet(self)
 
         self.optional_data = None  # list
         self.time_delivery = None
@@ -125,6 +136,17 @@ class Packet(Entity):
         # if the packet was sent with move routing or not
         self.is_move_packet = None
 
+    def __copy__(self):
+        """ a shallow copy, that is not the packet recorded in the metrics """
+        pck = self.__class__.__new__(self.__class__)
+        for cls in self.__class__.__mro__:
+            for slot in cls.__dict__.get("__slots__", ()):
+                # the private slots are stored mangled, e.g. __TTL as _Packet__TTL
+                slot = "_" + cls.__name__ + slot if slot.startswith("__") else slot
+                setattr(pck, slot, getattr(self, slot))
+        pck.metrics_row = None
+        return pck
+
     def get_TTL(self):
         return self.__TTL
 
@@ -150,15 +172,15 @@ class Packet(Entity):
     def add_hop(self, drone):
         """ add a new hop in the packet """
 
-        if len(self.last_2_hops) == 2:
-            self.last_2_hops = self.last_2_hops[1:]  # keep just the last two HOPS
-        self.last_2_hops.append(drone)
+        self.last_2_hops = self.last_2_hops[-1:] + (drone,)  # keep just the last two HOPS
 
         # self.hops.add(drone.identifier)
         self.increase_TTL_hops()
 
     def increase_TTL_hops(self):
         self.__TTL += 1
+        if self.metrics_row is not None:
+            self.simulator.metrics.record_packet_hop(self.metrics_row, self.__TTL)
 
     def increase_transmission_attempt(self):
         self.number_retransmission_attempt += 1
@@ -180,6 +202,8 @@ class Packet(Entity):
 class NeighborTable(Packet):
     """ Basically a Packet"""
 
+    __slots__ = ("sender", "info", "resend")
+
     def __init__(self, sender, info, time_step_creation, simulator, event_ref: Event = None):
         super().__init__(time_step_creation, simulator, event_ref)
 
@@ -190,6 +214,8 @@ class NeighborTable(Packet):
 class DPACKPacket(Packet):
     """ Basically a Packet"""
 
+    __slots__ = ("acked_packet", "src_drone", "dst_drone", "info")
+
     def __init__(self, src_drone, dst_drone, acked_packet, time_step_creation, simulator, info, event_ref: Event = None):
         super().__init__(time_step_creation, simulator, event_ref)
 
@@ -200,6 +226,8 @@ class DPACKPacket(Packet):
         self.dst_drone = dst_drone
 
         self.info = info
+        if self.metrics_row is not None:
+            self.simulator.metrics.record_packet_info(self.metrics_row, info)
 
     def to_json(self):
         """ return the json repr of the obj """
@@ -216,6 +244,8 @@ class DPACKPacket(Packet):
 class DiscoveryPacket(Packet):
     """ Basically a Packet"""
 
+    __slots__ = ("src_drone",)
+
     def __init__(self, src_drone, time_step_creation, simulator, event_ref: Event = None):
         super().__init__(time_step_creation, simulator, event_ref)
 
@@ -228,12 +258,16 @@ class DiscoveryPacket(Packet):
 class DataPacket(Packet):
     """ Basically a Packet"""
 
+    __slots__ = ("current_qtable",)
+
     def __init__(self, time_step_creation, simulator, event_ref: Event = None, current_qtable = None):
         super().__init__(time_step_creation, simulator, event_ref)
 
         self.current_qtable = current_qtable
 
 class ACKPacket(Packet):
+    __slots__ = ("acked_packet", "src_drone", "dst_drone", "holders")
+
     def __init__(self, src_drone, dst_drone, simulator, acked_packet, time_step_creation=None):
         super().__init__(time_step_creation, simulator, None)
         self.acked_packet = acked_packet  # packet that the drone who creates it wants to ACK
@@ -242,10 +276,14 @@ class ACKPacket(Packet):
         self.src_drone = src_drone
         self.dst_drone = dst_drone
 
+        self.holders = 0  # the medium and the drones holding the packet, see PacketPool
+
 
 class HelloPacket(Packet):
     """ The hello message is responsible to give info about neighborhood """
 
+    __slots__ = ("cur_pos", "speed", "next_target", "src_drone", "holders")
+
     def __init__(self, src_drone, time_step_creation, simulator, cur_pos, speed, next_target):
         super().__init__(time_step_creation, simulator, None)
         self.cur_pos = cur_pos
@@ -253,16 +291,71 @@ class HelloPacket(Packet):
         self.next_target = next_target
         self.src_drone = src_drone  # Don't use this
 
+        self.holders = 0  # the medium and the drones holding the packet, see PacketPool
+
+
+class PacketPool:
+    """ Recycles the short-lived control packets, HelloPacket and ACKPacket. The medium holds a packet until
+        it is delivered, a drone holds a hello while it is in its hello_messages: a packet that nobody holds
+        anymore goes back to the pool and is initialized again by the next acquire, with a new id.
+        When disabled, acquire allocates a new packet and hold and release do nothing.
+        acquire may be called by the threads deciding the drones of a synchronous step, hold and release
+        must not: the holders are counted without a lock, the changes they make are postponed to the commit
+        of the step (see BASE_routing.apply_effect).
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.free = {HelloPacket: [], ACKPacket: []}  # { packet class : released packets }
+        self.allocated = {HelloPacket: 0, ACKPacket: 0}  # { packet class : packets allocated by acquire }
+        self.__allocation_lock = threading.Lock()  # only taken when the pool is empty
+
+    def acquire(self, packet_class, *args):
+        """ return packet_class(*args), reusing a released packet if there is one """
+        if not self.enabled:
+            return packet_class(*args)
+
+        # a single pop, the drones of a synchronous step may acquire from several threads
+        try:
+            pck = self.free[packet_class].pop()
+        except IndexError:
+            with self.__allocation_lock:
+                self.allocated[packet_class] += 1
+            return packet_class(*args)
+        pck.__init__(*args)
+        return pck
+
+    def hold(self, packet):
+        """ a new reference to the packet is kept, until the matching release """
+        if self.enabled and packet.__class__ in self.free:
+            packet.holders += 1
+
+    def release(self, packet):
+        """ a reference to the packet is dropped, the packet is recycled once none is left """
+        if self.enabled and packet.__class__ in self.free:
+            # a second release of the same reference would recycle a packet that is still held
+            assert packet.holders > 0, f"packet {packet} released more times than held"
+            packet.holders -= 1
+            if packet.holders == 0:
+                # do not keep alive what the packet refers to while it waits in the pool
+                for slot in packet.__class__.__slots__:
+                    setattr(packet, slot, None)
+                packet.optional_data = None
+                packet.holders = 0
+                self.free[packet.__class__].append(packet)
+
 
 # ------------------ Depot ----------------------
 class Depot(Entity):
     """ The depot is an Entity. """
 
     def __init__(self, coords, communication_range, simulator):
-        super().__init__(id(self), coords, simulator)
+        super().__init__(next(simulator.entity_ids), coords, simulator)
         self.communication_range = communication_range
 
-        self.__buffer = list()  # also with duplicated packets
+        self.__buffer = dict()  # { insertion number : packet } also with duplicated packets
+        self.__insertions = 0
+        self.__deadlines = []  # heap of (deadline, insertion number), to find the expired packets
 
         self.routing_algorithm = self.simulator.routing_algorithm.value(self, self.simulator)
 
@@ -271,13 +364,19 @@ class Depot(Entity):
         self.temporary_neighbor_table = dict()
 
     def all_packets(self):
-        return self.__buffer
+        return list(self.__buffer.values())
+
+    def __add_packet(self, pck):
+        self.__buffer[self.__insertions] = pck
+        heapq.heappush(self.__deadlines, (pck.event_ref.deadline, self.__insertions))
+        self.__insertions += 1
 
     def transfer_notified_packets(self, current_drone, cur_step):
         """ function called when a drone wants to offload packets to the depot """
 
         packets_to_offload = current_drone.all_packets()
-        self.__buffer += packets_to_offload
+        for pck in packets_to_offload:
+            self.__add_packet(pck)
 
         for pck in packets_to_offload:
 
@@ -286,16 +385,16 @@ class Depot(Entity):
                 feedback = 1
                 delivery_delay = cur_step - pck.event_ref.current_time
 
-                for drone in self.simulator.drones:
-                    drone.routing_algorithm.feedback(current_drone,
-                                                     pck.event_ref.identifier,
-                                                     delivery_delay,
-                                                     feedback)
+                # to all the drones that took an action for the packet
+                self.simulator.routing_algorithm.value.batch_feedback(self.simulator,
+                                                                      current_drone,
+                                                                      pck.event_ref.identifier,
+                                                                      delivery_delay,
+                                                                      feedback)
             #print(f"DEPOT -> Drone {current_drone.identifier} packet: {pck.event_ref} total packets in sim: {len(self.simulator.metrics.drones_packets_to_depot)}")
 
             # add metrics: all the packets notified to the depot
-            self.simulator.metrics.drones_packets_to_depot.add((pck, cur_step))
-            self.simulator.metrics.drones_packets_to_depot_list.append((pck, cur_step))
+            self.simulator.metrics.record_packet_to_depot(pck, cur_step)
             pck.time_delivery = cur_step
 
     def feel_event(self, cur_step):
@@ -304,7 +403,7 @@ class Depot(Entity):
          """
         ev = Event(self.simulator.depot_coordinates, cur_step, self.simulator, discovery_packet_event=True)  # the event
         pk = ev.as_packet(cur_step, self)  # the packet of the event
-        self.__buffer.append(pk)
+        self.__add_packet(pk)
         self.simulator.metrics.all_discovery_packets_generated_in_simulation += 1
 
     def update_packets(self, cur_step):
@@ -314,13 +413,10 @@ class Depot(Entity):
         @param cur_step: Integer representing the current time step
         @return:
         """
-        tmp_buffer = []
-
-        for pck in self.all_packets():
-            if not pck.is_expired(cur_step):
-                tmp_buffer.append(pck)
-
-        self.__buffer = tmp_buffer
+        # the depot never removes packets in other ways, so all the entries of the heap are alive
+        while self.__deadlines and self.__deadlines[0][0] < cur_step:
+            _, insertion = heapq.heappop(self.__deadlines)
+            del self.__buffer[insertion]
 
     def routing(self, drones, depot, cur_step):
         """ do the routing """
@@ -339,6 +435,7 @@ class Drone(Entity):
 
     def __init__(self, identifier: int, path: list, depot: Depot, simulator):
 
+        self.__position_row = None  # row of the swarm positions array, when the movement is vectorized
         super().__init__(identifier, path[0], simulator)
 
         self.depot = depot
@@ -355,7 +452,11 @@ class Drone(Entity):
         self.tightest_event_deadline = None  # used later to check if there is an event that is about to expire
         self.current_waypoint = 0
 
-        self.__buffer = []  # contains the packets
+        self.__buffer = {}  # contains the packets { event id : packet }, in insertion order
+        self.__buffer_insertion = {}  # { event id : insertion number of the packet in the buffer }
+        self.__insertions = 0
+        # heap of (deadline, insertion number, event id), entries of packets no more in the buffer are skipped
+        self.__deadlines = []
 
         self.distance_from_depot = 0
         self.move_routing = False  # if true, it moves to the depot
@@ -374,6 +475,24 @@ class Drone(Entity):
         self.neighbor_table = dict()
         self.temporary_neighbor_table = dict()
 
+    @property
+    def coords(self):
+        if self.__position_row is None:
+            return self.__coords
+        return tuple(self.__position_row.tolist())
+
+    @coords.setter
+    def coords(self, coords):
+        if self.__position_row is None:
+            self.__coords = coords
+        else:
+            self.__position_row[:] = coords
+
+    def attach_position_row(self, position_row):
+        """ from now on the position of the drone lives in position_row, a view on the swarm positions array """
+        position_row[:] = self.coords
+        self.__position_row = position_row
+
     def update_packets(self, cur_step):
         """
         Removes the expired packets from the buffer
@@ -381,34 +500,45 @@ class Drone(Entity):
         @param cur_step: Integer representing the current time step
         @return:
         """
-        to_remove_packets = 0
-        tmp_buffer = []
-        self.tightest_event_deadline = np.nan
-
-        for pck in self.__buffer:
-            if not pck.is_expired(cur_step):
-                tmp_buffer.append(pck)  # append again only if it is not expired
-                self.tightest_event_deadline = np.nanmin([self.tightest_event_deadline, pck.event_ref.deadline])
+        expired_packets = []
+        while self.__deadlines and self.__deadlines[0][0] < cur_step:
+            _, insertion, event_id = heapq.heappop(self.__deadlines)
+            if self.__buffer_insertion.get(event_id) == insertion:
+                expired_packets.append((insertion, event_id))
+
+        # the expired packets are handled in buffer order, i.e. in insertion order
+        expired_packets.sort()
+        for _, event_id in expired_packets:
+            pck = self.__buffer.pop(event_id)
+            del self.__buffer_insertion[event_id]
 
-            else:
-
-                to_remove_packets += 1
+            if self.simulator.routing_algorithm.name not in "GEO" "RND" "GEOS":
 
-                if self.simulator.routing_algorithm.name not in "GEO" "RND" "GEOS":
+                feedback = -1
+                current_drone = self
 
-                    feedback = -1
-                    current_drone = self
+                # to all the drones that took an action for the packet
+                self.routing_algorithm.apply_effect(self.simulator.routing_algorithm.value.batch_feedback,
+                                                    self.simulator,
+                                                    current_drone,
+                                                    pck.event_ref.identifier,
+                                                    self.simulator.event_duration,
+                                                    feedback)
 
-                    for drone in self.simulator.drones:
-                        drone.routing_algorithm.feedback(current_drone,
-                                                         pck.event_ref.identifier,
-                                                         self.simulator.event_duration,
-                                                         feedback)
-        self.__buffer = tmp_buffer
+        # drop the entries of removed packets from the top, the top is the tightest deadline in the buffer
+        while self.__deadlines and self.__buffer_insertion.get(self.__deadlines[0][2]) != self.__deadlines[0][1]:
+            heapq.heappop(self.__deadlines)
+        self.tightest_event_deadline = self.__deadlines[0][0] if self.__deadlines else np.nan
 
         if self.buffer_length() == 0:
             self.move_routing = False
 
+    def next_update_step(self, cur_step):
+        """ the first step after cur_step in which update_packets may change the drone, inf if none """
+        if self.move_routing and len(self.__buffer) == 0:
+            return cur_step + 1
+        return self.__deadlines[0][0] + 1 if self.__deadlines else np.inf
+
     def packet_is_expiring(self, cur_step):
         """ return true if exist a packet that is expiring and must be returned to the depot as soon as possible
             -> start to move manually to the depot.
@@ -450,10 +580,10 @@ class Drone(Entity):
         ev = Event(self.coords, cur_step, self.simulator)  # the event
         pk = ev.as_packet(cur_step, self)  # the packet of the event
         if not self.move_routing and not self.come_back_to_mission:
-            self.__buffer.append(pk)
+            self.__add_packet(pk)
             self.simulator.metrics.all_data_packets_in_simulation += 1
         else:  # store the events that are missing due to movement routing
-            self.simulator.metrics.events_not_listened.add(ev)
+            self.simulator.metrics.record_not_listened_event(ev)
 
     def accept_packets(self, packets):
         """ Self drone adds packets of another drone, when it feels it passing by. """
@@ -463,11 +593,11 @@ class Drone(Entity):
             # because they have already been notified by someone already
 
             if not self.is_known_packet(packet):
-                self.__buffer.append(packet)
+                self.__add_packet(packet)
 
     def routing(self, drones, depot, cur_step):
         """ do the routing """
-        self.distance_from_depot = utilities.euclidean_distance(self.depot.coords, self.coords)
+        self.distance_from_depot = self.simulator.distance_matrix.depot_distance(self)
         self.routing_algorithm.routing(depot, drones, cur_step)
 
     def move(self, time):
@@ -498,21 +628,72 @@ class Drone(Entity):
         # set the last move routing
         self.last_move_routing = self.move_routing
 
+    def begin_vectorized_move(self):
+        """ the bookkeeping done by move before updating the position, used when all the drones are moved at once.
+            Return the point the drone moves towards.
+        """
+        if self.move_routing or self.come_back_to_mission:
+            self.simulator.metrics.time_on_active_routing += 1
+
+        if self.move_routing:
+            if not self.last_move_routing:  # this is the first time that we are doing move-routing
+                self.last_mission_coords = self.coords
+            target = self.depot.coords
+        else:
+            if self.last_move_routing:  # I'm coming back to the mission
+                self.come_back_to_mission = True
+
+            if self.current_waypoint >= len(self.path) - 1:
+                self.current_waypoint = -1
+
+            if self.come_back_to_mission:
+                target = self.last_mission_coords
+            else:
+                target = self.path[self.current_waypoint + 1]
+
+            self.simulator.metrics.time_on_mission += 1
+
+        self.last_move_routing = self.move_routing
+        return target
+
+    def end_vectorized_move(self, target, all_distance):
+        """ called on the drones that reached their target during a vectorized move """
+        if self.move_routing:
+            if all_distance == 0:  # already on the depot
+                self.move_routing = False
+                self.last_move_routing = False
+            else:
+                self.coords = target
+        else:
+            self.__update_position(target)
+
     def is_full(self):
         return self.buffer_length() == self.buffer_max_size
 
     def is_known_packet(self, packet: DataPacket):
         """ Returns True if drone has already a similar packet (i.e., referred to the same event).  """
-        for pk in self.__buffer:
-            if pk.event_ref == packet.event_ref:
-                return True
-        return False
+        return packet.event_ref.identifier in self.__buffer
+
+    def __add_packet(self, packet):
+        event_id = packet.event_ref.identifier
+        self.__buffer[event_id] = packet
+        self.__buffer_insertion[event_id] = self.__insertions
+        heapq.heappush(self.__deadlines, (packet.event_ref.deadline, self.__insertions, event_id))
+        self.__insertions += 1
+
+        # too many entries of removed packets, rebuild the heap out of the buffer
+        if len(self.__deadlines) > 2 * len(self.__buffer) + 64:
+            self.__deadlines = [(pck.event_ref.deadline, self.__buffer_insertion[event_id], event_id)
+                                for event_id, pck in self.__buffer.items()]
+            heapq.heapify(self.__deadlines)
 
     def empty_buffer(self):
-        self.__buffer = []
+        self.__buffer = {}
+        self.__buffer_insertion = {}
+        self.__deadlines = []
 
     def all_packets(self):
-        return self.__buffer
+        return list(self.__buffer.values())
 
     def buffer_length(self):
         return len(self.__buffer)
@@ -520,8 +701,9 @@ class Drone(Entity):
     def remove_packets(self, packets):
         """ Removes the packets from the buffer. """
         for packet in packets:
-            if packet in self.__buffer:
-                self.__buffer.remove(packet)
+            if self.__buffer.get(packet.event_ref.identifier) == packet:
+                del self.__buffer[packet.event_ref.identifier]
+                del self.__buffer_insertion[packet.event_ref.identifier]
                 if config.DEBUG:
                     print("ROUTING del: drone: " + str(self.identifier) + " - removed a packet id: " + str(
                         packet.identifier))
@@ -2,8 +2,17 @@ from src.utilities.experiments_config import *
 from src.experiments.parser.parser import command_line_parser
 from src.utilities import config
 from src.simulation.simulator import Simulator
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import json
 import os
 
+# the file, in config.EXPERIMENTS_DIR, that keeps track of the runs of launch_parallel_experiments
+MANIFEST_FILE = "manifest.json"
+
+# the config module as it is when a worker process starts, restored before every job
+_config_snapshot = None
+
 
 def sim_setup(n_drones, seed, algorithm):
     """
@@ -69,19 +78,122 @@ def launch_experiments(n_drones, in_seed, out_seed, algorithm):
         simulation.close()
 
 
+def experiment_output_path(n_drones, seed, algorithm):
+    """ the path of the json that Simulator.close writes for the given run """
+    simulation_name = "out__" + str(seed) + "_" + str(n_drones) + "_" + str(config.RoutingAlgorithm[algorithm])
+    return config.ROOT_EVALUATION_DATA + simulation_name + ".json"
+
+
+def snapshot_config():
+    """ worker initializer: save the module level config as it is after the import """
+    global _config_snapshot
+    _config_snapshot = {key: value for key, value in vars(config).items() if not key.startswith("__")}
+
+
+def restore_config():
+    """ bring the module level config back to the snapshot, so every job starts from the same config """
+    for key in [key for key in vars(config) if not key.startswith("__") and key not in _config_snapshot]:
+        delattr(config, key)
+    for key, value in _config_snapshot.items():
+        setattr(config, key, value)
+
+
+def run_experiment(n_drones, seed, algorithm):
+    """
+    Run and save a single simulation, it is the job executed by the workers of launch_parallel_experiments
+    @param n_drones: the number of drones during the simulation
+    @param seed: the simulation seed
+    @param algorithm: the algorithm used to route the packets
+    @return: the (n_drones, seed, algorithm) of the run
+    """
+    restore_config()
+
+    simulation = sim_setup(n_drones, seed, algorithm)
+
+    simulation.run()
+
+    simulation.close()
+
+    return n_drones, seed, algorithm
+
+
+def launch_parallel_experiments(drones_numbers, in_seed, out_seed, algorithms, max_workers=None):
+    """
+    The function launches the simulations for all the combinations of drones number, seed (from in_seed up to
+    out_seed) and algorithm on a pool of processes. The runs whose json already exists are skipped, so an
+    interrupted campaign can be resumed, and the outcome of every run is written in the manifest file.
+    @param drones_numbers: list of integers that describe the number of drones
+    @param in_seed: integer that describe the initial seed
+    @param out_seed: integer that describe the final seed
+    @param algorithms: list of routing algorithms
+    @param max_workers: the maximum number of processes, by default the number of cores
+    @return: the manifest, a dictionary { run name : outcome }
+    """
+
+    manifest_path = config.EXPERIMENTS_DIR + MANIFEST_FILE
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+
+    jobs = []
+    for n_drones in drones_numbers:
+        for algorithm in algorithms:
+            for seed in range(in_seed, out_seed):
+                run_name = experiment_output_path(n_drones, seed, algorithm)
+                if os.path.exists(run_name):
+                    manifest[run_name] = "done"
+                else:
+                    jobs.append((n_drones, seed, algorithm))
+
+    n_done = sum(1 for outcome in manifest.values() if outcome == "done")
+    print(f"Running {len(jobs)} simulations, {n_done} already done")
+
+    if len(jobs) > 0:
+        n_workers = max(1, min(max_workers or os.cpu_count(), len(jobs)))
+
+        # spawned workers import a fresh copy of the config, instead of inheriting the parent one
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=snapshot_config) as pool:
+
+            futures = {pool.submit(run_experiment, *job): job for job in jobs}
+            for future in as_completed(futures):
+                n_drones, seed, algorithm = futures[future]
+                run_name = experiment_output_path(n_drones, seed, algorithm)
+
+                try:
+                    future.result()
+                    manifest[run_name] = "done"
+                except Exception as e:
+                    manifest[run_name] = "failed: " + repr(e)
+
+                print(f"{algorithm} with {n_drones} drones seed {seed}: {manifest[run_name]}")
+
+                with open(manifest_path, "w") as manifest_file:
+                    json.dump(manifest, manifest_file, indent=2)
+
+    return manifest
+
+
 if __name__ == "__main__":
 
     args = command_line_parser.parse_args()
 
-    number_of_drones = args.number_of_drones
+    numbers_of_drones = args.number_of_drones
     initial_seed = args.initial_seed
     end_seed = args.end_seed
-    algorithm_routing = args.algorithm_routing
+    algorithms_routing = args.algorithm_routing
     path_filename = config.EXPERIMENTS_DIR
 
     # build directories for results and models
     os.system("mkdir " + path_filename)
 
-    launch_experiments(number_of_drones, initial_seed, end_seed, algorithm_routing)
+    if args.workers is None:
+        for number_of_drones in numbers_of_drones:
+            for algorithm_routing in algorithms_routing:
+                launch_experiments(number_of_drones, initial_seed, end_seed, algorithm_routing)
+    else:
+        launch_parallel_experiments(numbers_of_drones, initial_seed, end_seed, algorithms_routing, args.workers)
 
     print("Simulations completed!")
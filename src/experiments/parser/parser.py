@@ -5,12 +5,15 @@ command_line_parser = ArgumentParser()
 
 routing_choices = config.RoutingAlgorithm.keylist()
 
-command_line_parser.add_argument("-nd", dest='number_of_drones', action="store", type=int,
-                                 help="the number of drones to use in the simulataion")
+command_line_parser.add_argument("-nd", dest='number_of_drones', action="store", type=int, nargs="+",
+                                 help="the number of drones to use in the simulataion, one or more")
 command_line_parser.add_argument("-i_s", dest='initial_seed', action="store", type=int,
                                  help="the initial seed (included) to use in the simualtions")
 command_line_parser.add_argument("-e_s", dest='end_seed', action="store", type=int,
                                  help="the end seed (excluded) to use in the simualtions"
                          + "-notice that the simulations will run for seed in (i_s, e_s)")
-command_line_parser.add_argument("-alg", dest='algorithm_routing', action="store", type=str,
-                                 choices=routing_choices, help="the routing algorithm to use")
\ No newline at end of file
+command_line_parser.add_argument("-alg", dest='algorithm_routing', action="store", type=str, nargs="+",
+                                 choices=routing_choices, help="the routing algorithm to use, one or more")
+command_line_parser.add_argument("-w", dest='workers', action="store", type=int, default=None,
+                                 help="run the simulations on a pool of at most w processes, "
+                         + "skipping the ones already saved")
\ No newline at end of file
@@ -1,12 +1,46 @@
-from src.entities.uav_entities import DataPacket, ACKPacket, HelloPacket, Packet, DiscoveryPacket, DPACKPacket, NeighborTable
-from src.utilities import utilities as util
+from src.entities.uav_entities import DataPacket, ACKPacket, HelloPacket, Packet, DiscoveryPacket, DPACKPacket, NeighborTable, Depot
 from src.utilities import config
 
 from scipy.stats import norm
+import numpy as np
+import heapq
+import math
 import abc
 
+from functools import lru_cache
 from copy import copy
 
+
+@lru_cache(maxsize=None)
+def gaussian_buckets(communication_range, mu=0, sigma_wrt_range=1.15, bucket_width_wrt_range=.5):
+    """
+    The probability of success of the gaussian channel in every bucket of distance, the same for all the
+    entities with the same communication range, so it is computed once and shared.
+    The buckets are looked up one distance at a time (see BASE_routing.gaussian_success_handler): the medium is
+    error free and no sender evaluates the channel, so there is no array of distances to evaluate at once.
+    @return: the bucket width and the read-only array of the probabilities, the bucket i starts at i * width
+    """
+    # bucket width is 0.5 times the communication radius by default
+    radius_corona = int(communication_range * bucket_width_wrt_range)
+
+    # sigma is 1.15 times the communication radius by default
+    sigma = communication_range * sigma_wrt_range
+
+    max_prob = norm.cdf(mu + radius_corona, loc=mu, scale=sigma) - norm.cdf(0, loc=mu, scale=sigma)
+
+    # maps a bucket number to its probability of gaussian success
+    buckets_probability = []
+    for bk in range(0, communication_range, radius_corona):
+        prob_leq = norm.cdf(bk, loc=mu, scale=sigma)
+        prob_leq_plus = norm.cdf(bk + radius_corona, loc=mu, scale=sigma)
+        prob = (prob_leq_plus - prob_leq) / max_prob
+        buckets_probability.append(prob)
+
+    buckets_probability = np.array(buckets_probability, dtype=float)
+    buckets_probability.setflags(write=False)
+    return radius_corona, buckets_probability
+
+
 class BASE_routing(metaclass=abc.ABCMeta):
 
     def __init__(self, entity, simulator):
@@ -14,12 +48,19 @@ class BASE_routing(metaclass=abc.ABCMeta):
 
         self.entity = entity
         self.current_n_transmission = 0
-        self.hello_messages = {}  # { drone_id : most recent hello packet}
+        self.hello_messages = {}  # { drone_id : most recent hello packet}, only the ones not too old
+        self.__hello_expiry = []  # heap of (time step creation, drone_id) of the received hellos
+        self.__first_heard = {}  # { drone_id : rank of the first hello received from the drone }
+        self.__opt_neighbors = None  # the (hello, drone) of the fresh hellos, None when it must be rebuilt
+        self.__opt_neighbors_valid_until = None  # the last step in which none of them is too old
         self.network_disp = simulator.network_dispatcher
         self.simulator = simulator
+        self.pending_effects = None  # the changes to the shared state postponed during a synchronous step
+        # the random draws of the entity, see Simulator.random_stream
+        self.rnd = simulator.random_stream("depot" if isinstance(entity, Depot) else entity.identifier)
 
         if self.simulator.communication_error_type == config.ChannelError.GAUSSIAN:
-            self.buckets_probability = self.__init_guassian()
+            self.radius_corona, self.buckets_probability = gaussian_buckets(self.entity.communication_range)
         self.no_transmission = False
         
 
@@ -27,6 +68,25 @@ class BASE_routing(metaclass=abc.ABCMeta):
     def relay_selection(self, geo_neighbors, packet):
         pass
 
+    def prepare_relay_selection(self, opt_neighbors):
+        """ called once before the relay_selection of all the packets in the buffer, with the same opt_neighbors """
+        pass
+
+    def apply_effect(self, effect, *args):
+        """ call effect(*args), a change of the state shared with the other drones. During a synchronous step
+            the call is postponed to commit_effects, so that all the drones decide on the same state.
+        """
+        if self.pending_effects is None:
+            effect(*args)
+        else:
+            self.pending_effects.append((effect, args))
+
+    def commit_effects(self):
+        """ apply the changes postponed during the synchronous step, in the order they were made """
+        pending_effects, self.pending_effects = self.pending_effects, None
+        for effect, args in pending_effects:
+            effect(*args)
+
     def routing_close(self):
         self.no_transmission = False
 
@@ -35,13 +95,22 @@ class BASE_routing(metaclass=abc.ABCMeta):
         """ handle reception an ACKs for a packets """
         if isinstance(packet, HelloPacket):
             src_id = packet.src_drone.identifier
+            self.simulator.packets_pool.hold(packet)
+            old_hello = self.hello_messages.get(src_id)
+            if old_hello is not None:
+                self.simulator.packets_pool.release(old_hello)
             self.hello_messages[src_id] = packet  # add packet to our dictionary
+            self.__first_heard.setdefault(src_id, len(self.__first_heard))
+            heapq.heappush(self.__hello_expiry, (packet.time_step_creation, src_id))
+            self.__evict_old_hellos(current_ts)
+            self.__opt_neighbors = None
 
         elif isinstance(packet, DataPacket):
             self.no_transmission = True
             self.entity.accept_packets([packet])
             # build ack for the reception
-            ack_packet = ACKPacket(self.entity, src_entity, self.simulator, packet, current_ts)
+            ack_packet = self.simulator.packets_pool.acquire(ACKPacket, self.entity, src_entity, self.simulator,
+                                                             packet, current_ts)
             self.unicast_message(ack_packet, self.entity, src_entity, current_ts)
 
         elif isinstance(packet, ACKPacket):
@@ -112,16 +181,10 @@ class BASE_routing(metaclass=abc.ABCMeta):
         if cur_step % config.HELLO_DELAY != 0:  # still not time to communicate
             return
 
-        my_hello = HelloPacket(self.entity, cur_step, self.simulator, self.entity.coords,
-                        self.entity.speed, self.entity.next_target())
-        
-        # to update the QTable we need to have the qtable of the drone chosen as relay, 
-        # then we added it as optional data to the hello packet
-        if self.simulator.routing_algorithm == config.RoutingAlgorithm.QL:
-            my_hello.append_optional_data(data={
-                "relay_qtable": self.qtable
-            })
-        
+        my_hello = self.simulator.packets_pool.acquire(HelloPacket, self.entity, cur_step, self.simulator,
+                                                       self.entity.coords, self.entity.speed,
+                                                       self.entity.next_target())
+
         self.broadcast_message(my_hello, self.entity, drones, cur_step)
 
     def routing(self, depot, drones, cur_step):
@@ -168,9 +231,9 @@ class BASE_routing(metaclass=abc.ABCMeta):
             return
 
         # FLOW 1
-        if util.euclidean_distance(self.simulator.depot.coords, self.entity.coords) <= self.simulator.depot_com_range:
+        if self.simulator.neighbor_grid.in_depot_range(self.entity):
             # add error in case
-            self.transfer_to_depot(self.entity.depot, cur_step)
+            self.apply_effect(self.transfer_to_depot, self.entity.depot, cur_step)
 
             self.entity.move_routing = False
             self.current_n_transmission = 0
@@ -180,23 +243,18 @@ class BASE_routing(metaclass=abc.ABCMeta):
 
         if cur_step % self.simulator.drone_retransmission_delta == 0:
 
-            opt_neighbors = []
-            for hpk_id in self.hello_messages:
-                hpk: HelloPacket = self.hello_messages[hpk_id]
-
-                # check if packet is too old
-                if hpk.time_step_creation < cur_step - config.OLD_HELLO_PACKET:
-                    continue
-
-                opt_neighbors.append((hpk, hpk.src_drone))
+            opt_neighbors = self.__fresh_neighbors(cur_step)
 
             if len(opt_neighbors) == 0:
                 return
 
-            # send packets
-            for pkd in self.entity.all_packets():
+            self.prepare_relay_selection(opt_neighbors)
+
+            packets = self.entity.all_packets()
+            self.apply_effect(self.simulator.metrics.record_possible_relays, len(opt_neighbors), len(packets))
 
-                self.simulator.metrics.mean_numbers_of_possible_relays.append(len(opt_neighbors))
+            # send packets
+            for pkd in packets:
 
                 best_neighbor = self.relay_selection(opt_neighbors, pkd)  # compute score
 
@@ -206,70 +264,55 @@ class BASE_routing(metaclass=abc.ABCMeta):
 
                 self.current_n_transmission += 1
 
-    def geo_neighborhood(self, drones, no_error=False):
-        """
-        @param drones:
-        @param no_error:
-        @return: A list all the Drones that are in self.entity neighbourhood (no matter the distance to depot),
-            in all direction in its transmission range, paired with their distance from self.entity
-        """
-
-        closest_drones = []  # list of this drone's neighbours and their distance from self.entity: (drone, distance)
-
-        for other_drone in drones:
-
-            if self.entity.identifier != other_drone.identifier:  # not the same drone
-                drones_distance = util.euclidean_distance(self.entity.coords,
-                                                          other_drone.coords)  # distance between two drones
-
-                if drones_distance <= min(self.entity.communication_range,
-                                          other_drone.communication_range):  # one feels the other & vv
-
-                    # CHANNEL UNPREDICTABILITY
-                    if self.channel_success(drones_distance, no_error=no_error):
-                        closest_drones.append((other_drone, drones_distance))
-
-        return closest_drones
-
-    def channel_success(self, drones_distance, no_error=False):
-        """
-        Precondition: two drones are close enough to communicate. Return true if the communication
-        goes through, false otherwise.
+    def __fresh_neighbors(self, cur_step):
+        """ the (hello, drone) of the neighbors whose hello is not too old, in the order they were first heard.
+            The list is rebuilt only when a new hello arrives or when one of its hellos gets too old, it must
+            not be modified.
         """
+        if self.__opt_neighbors is None or cur_step > self.__opt_neighbors_valid_until:
+            self.__evict_old_hellos(cur_step)
 
-        assert (drones_distance <= self.entity.communication_range)
-
-        if no_error:
-            return True
+            opt_neighbors = []
+            for hpk_id in sorted(self.hello_messages, key=self.__first_heard.get):
+                hpk: HelloPacket = self.hello_messages[hpk_id]
+                opt_neighbors.append((hpk, hpk.src_drone))
 
-        if self.simulator.communication_error_type == config.ChannelError.NO_ERROR:
-            return True
+            self.__opt_neighbors = opt_neighbors
+            self.__opt_neighbors_valid_until = min((hpk.time_step_creation for hpk, _ in opt_neighbors),
+                                                   default=math.inf) + config.OLD_HELLO_PACKET
 
-        elif self.simulator.communication_error_type == config.ChannelError.UNIFORM:
-            return self.simulator.rnd_routing.rand() <= self.simulator.drone_communication_success
+        return self.__opt_neighbors
 
-        elif self.simulator.communication_error_type == config.ChannelError.GAUSSIAN:
-            return self.simulator.rnd_routing.rand() <= self.gaussian_success_handler(drones_distance)
+    def __evict_old_hellos(self, cur_step):
+        """ forget the hellos too old to be used from cur_step on """
+        while self.__hello_expiry and self.__hello_expiry[0][0] < cur_step - config.OLD_HELLO_PACKET:
+            time_step_creation, hpk_id = heapq.heappop(self.__hello_expiry)
+            # unless the drone sent a newer hello
+            hpk = self.hello_messages.get(hpk_id)
+            if hpk is not None and hpk.time_step_creation == time_step_creation:
+                del self.hello_messages[hpk_id]
+                # the holders of the hello are shared with the other drones, the release is not done on a thread
+                self.apply_effect(self.simulator.packets_pool.release, hpk)
 
     def broadcast_message(self, packet, src_drone, dst_drones, curr_step):
-        """ send a message to my neigh drones"""
-        for d_drone in dst_drones:
-            self.unicast_message(packet, src_drone, d_drone, curr_step)
+        """ send a message to my neigh drones, the medium delivers it to the ones in range """
+        self.apply_effect(self.simulator.network_dispatcher.send_broadcast_to_medium, packet, src_drone,
+                          len(dst_drones), self.__delivery_ts(packet, curr_step))
 
     def unicast_message(self, packet, src_drone, dst_drone, curr_step):
         """ send a message to my neigh drones"""
-        # Broadcast using Network dispatcher
+        self.apply_effect(self.simulator.network_dispatcher.send_packet_to_medium, packet, src_drone, dst_drone,
+                          self.__delivery_ts(packet, curr_step))
 
+    def __delivery_ts(self, packet, curr_step):
+        """ the time step in which the medium delivers the packet """
         if isinstance(packet, DiscoveryPacket) and config.MORE_OPTIONS:
-            self.simulator.network_dispatcher.send_packet_to_medium(packet, src_drone, dst_drone,
-                                                                curr_step + config.DP_DELAY)
-        else:
-            self.simulator.network_dispatcher.send_packet_to_medium(packet, src_drone, dst_drone,
-                                                                    curr_step + config.LIL_DELTA)
+            return curr_step + config.DP_DELAY
+        return curr_step + config.LIL_DELTA
 
     def gaussian_success_handler(self, drones_distance):
         """ get the probability of the drone bucket """
-        bucket_id = int(drones_distance / self.radius_corona) * self.radius_corona
+        bucket_id = min(int(drones_distance / self.radius_corona), len(self.buckets_probability) - 1)
         return self.buckets_probability[bucket_id] * config.GUASSIAN_SCALE
 
     def transfer_to_depot(self, depot, cur_step):
@@ -279,24 +322,3 @@ class BASE_routing(metaclass=abc.ABCMeta):
         depot.transfer_notified_packets(self.entity, cur_step)
         self.entity.empty_buffer()
         self.entity.move_routing = False
-
-    # --- PRIVATE ---
-    def __init_guassian(self, mu=0, sigma_wrt_range=1.15, bucket_width_wrt_range=.5):
-
-        # bucket width is 0.5 times the communication radius by default
-        self.radius_corona = int(self.entity.communication_range * bucket_width_wrt_range)
-
-        # sigma is 1.15 times the communication radius by default
-        sigma = self.entity.communication_range * sigma_wrt_range
-
-        max_prob = norm.cdf(mu + self.radius_corona, loc=mu, scale=sigma) - norm.cdf(0, loc=mu, scale=sigma)
-
-        # maps a bucket starter to its probability of gaussian success
-        buckets_probability = {}
-        for bk in range(0, self.entity.communication_range, self.radius_corona):
-            prob_leq = norm.cdf(bk, loc=mu, scale=sigma)
-            prob_leq_plus = norm.cdf(bk + self.radius_corona, loc=mu, scale=sigma)
-            prob = (prob_leq_plus - prob_leq) / max_prob
-            buckets_probability[bk] = prob
-
-        return buckets_probability
@@ -1,51 +1,92 @@
-
-import src.utilities.utilities as util
 from src.entities.uav_entities import DataPacket, DiscoveryPacket, DPACKPacket, NeighborTable, Depot
 from src.simulation.metrics import Metrics
+from collections import defaultdict
+import math
 
 from src.utilities import config
 
 class MediumDispatcher:
 
-    def __init__(self, metric_class: Metrics):
-        self.packets = []
+    def __init__(self, metric_class: Metrics, simulator):
+        # { to_send_ts : [(packet, src_drone, dst_drone, to_send_ts), ...] }, each bucket keeps the sending order.
+        # A broadcast is a single entry with dst_drone None
+        self.packets = defaultdict(list)
         self.metric_class = metric_class
+        self.simulator = simulator
 
     def send_packet_to_medium(self, packet, src_drone, dst_drone, to_send_ts):
 
+        self.__check_send_ts(to_send_ts)
+
         if not isinstance(packet, DataPacket):
             self.metric_class.all_control_packets_in_simulation += 1
 
-        self.packets.append((packet, src_drone, dst_drone, to_send_ts))
-
-    def run_medium(self, current_ts):
-        to_drop_indices = []
-        original_self_packets = self.packets[:]
-        self.packets = []
-
-        for i in range(len(original_self_packets)):
-            packet, src_drone, dst_drone, to_send_ts = original_self_packets[i]
+        self.simulator.packets_pool.hold(packet)
+        self.packets[to_send_ts].append((packet, src_drone, dst_drone, to_send_ts))
 
-            if to_send_ts == current_ts:  # time to send this packet
-                to_drop_indices.append(i)
+    def send_broadcast_to_medium(self, packet, src_drone, n_addressed_drones, to_send_ts):
+        """ a single medium entry, delivered to all the drones in range of src_drone at to_send_ts """
+        self.__check_send_ts(to_send_ts)
 
-                if src_drone.identifier != dst_drone.identifier:
-                    drones_distance = util.euclidean_distance(src_drone.coords, dst_drone.coords)
-                    if drones_distance <= min(src_drone.communication_range, dst_drone.communication_range):
-                        if dst_drone.routing_algorithm.channel_success(drones_distance, no_error=True):
-
-                            if isinstance(packet, DiscoveryPacket):
-                                self.metric_class.all_discovery_packets_sent += 1
-
-                            elif isinstance(packet, DPACKPacket):
-                                self.metric_class.all_dpack_packets_in_simulation += 1
-                            
-                            elif isinstance(packet, NeighborTable):
-                                self.metric_class.all_neighbor_table_packets_in_simulation += 1
+        if not isinstance(packet, DataPacket):
+            if config.BROADCAST_ACCOUNTING == config.BroadcastAccounting.PER_RECEIVER:
+                self.metric_class.all_control_packets_in_simulation += n_addressed_drones
+            else:
+                self.metric_class.all_control_packets_in_simulation += 1
 
-                            dst_drone.routing_algorithm.drone_reception(src_drone, packet, current_ts)  # reception of a packet
+        self.simulator.packets_pool.hold(packet)
+        self.packets[to_send_ts].append((packet, src_drone, None, to_send_ts))
 
+    def __check_send_ts(self, to_send_ts):
+        """ the bucket of the current step was already delivered, a packet due by then would stay in the medium
+            forever (e.g. with config.LIL_DELTA = 0)
+        """
+        assert to_send_ts > self.simulator.cur_step, \
+            f"packet due at step {to_send_ts}, the medium already ran step {self.simulator.cur_step}"
 
-        original_self_packets = [original_self_packets[i] for i in range(len(original_self_packets)) if
-                                 i not in to_drop_indices]
-        self.packets = original_self_packets + self.packets
+    def run_medium(self, current_ts):
+        # only the packets due at current_ts are touched, the others stay in their buckets
+        due_packets = self.packets.pop(current_ts, None)
+        if due_packets is None:
+            return
+
+        # the medium is error free: every packet due at current_ts reaches the drones in range, in order
+        for packet, src_drone, dst_drone, to_send_ts in due_packets:
+
+            if dst_drone is None:
+                # broadcast: fan out to the drones in range, in the order of their identifiers
+                for dst_drone, drones_distance in self.simulator.neighbor_grid.drones_in_range(
+                        src_drone, src_drone.communication_range):
+                    if drones_distance <= dst_drone.communication_range:
+                        self.__deliver(packet, src_drone, dst_drone, current_ts)
+
+            elif src_drone.identifier != dst_drone.identifier:
+                drones_distance = self.simulator.neighbor_grid.distance_in_range(
+                    src_drone, dst_drone, min(src_drone.communication_range, dst_drone.communication_range))
+                if drones_distance is not None:
+                    self.__deliver(packet, src_drone, dst_drone, current_ts)
+
+        # the medium is done with the packets of the step, delivered or lost
+        for packet, _, _, _ in due_packets:
+            self.simulator.packets_pool.release(packet)
+
+    def __deliver(self, packet, src_drone, dst_drone, current_ts):
+        """ the packet went through the channel, dst_drone receives it """
+        if isinstance(packet, DiscoveryPacket):
+            self.metric_class.all_discovery_packets_sent += 1
+
+        elif isinstance(packet, DPACKPacket):
+            self.metric_class.all_dpack_packets_in_simulation += 1
+
+        elif isinstance(packet, NeighborTable):
+            self.metric_class.all_neighbor_table_packets_in_simulation += 1
+
+        dst_drone.routing_algorithm.drone_reception(src_drone, packet, current_ts)  # reception of a packet
+
+    def next_delivery_step(self):
+        """ the first step in which the medium has packets to deliver, inf if it is empty """
+        return min(self.packets, default=math.inf)
+
+    def __len__(self):
+        """ the number of packets still travelling in the medium """
+        return sum(len(bucket) for bucket in self.packets.values())
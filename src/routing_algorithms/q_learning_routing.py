@@ -1,6 +1,9 @@
 from src.routing_algorithms.BASE_routing import BASE_routing
 from src.routing_algorithms.random_routing import RandomRouting as RND
+from src.entities.uav_entities import Depot
 from src.utilities import utilities as util
+from src.utilities import config
+import numpy as np
 import math, random
 
 LEARNING_RATE = 0.77
@@ -20,15 +23,144 @@ MAX_VALUE = 1
 # the minimum value of the reward
 MIN_VALUE = -1
 
+class LinkQualityWindow:
+    """ The most recent link quality values towards a neighbor, at most capacity of them in a ring buffer. """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.values = []  # grows up to capacity, then the oldest value is overwritten
+        self.next = 0  # the number of values appended so far
+
+    def append(self, value):
+        if len(self.values) < self.capacity:
+            self.values.append(value)
+        else:
+            self.values[self.next % self.capacity] = value
+        self.next += 1
+
+    def last(self):
+        return self.values[(self.next - 1) % self.capacity]
+
+    def sum_before_last(self, n_values):
+        """ the sum of the (at most) n_values values before the last one, from the oldest, as
+            sum(history[:-1][-n_values:]) would do on the whole history
+        """
+        n_values = min(n_values, len(self.values) - 1)
+        return sum(self.values[i % self.capacity] for i in range(self.next - 1 - n_values, self.next - 1))
+
+
+class SwarmQTable:
+    """ The Q-values of the whole swarm and the actions taken by the drones and still waiting for a feedback.
+        The row i of the (n_drones, n_drones) matrix is the qtable of drone i. The taken actions are kept in
+        parallel arrays, a slot for each (drone, event) pair, so that all the Bellman updates triggered by the
+        delivery or the expiration of a packet are applied with numpy. The slots of every event are indexed, so the
+        feedback only touches the drones that took an action for the packet.
+    """
+
+    def __init__(self, n_drones, capacity=256):
+        self.n_drones = n_drones
+        self.q = np.zeros((n_drones, n_drones), dtype=float)
+
+        # the taken actions, slot by slot
+        self.states = np.zeros(capacity, dtype=int)  # the drone that took the action
+        self.actions = np.zeros(capacity, dtype=int)  # the drone chosen as relay
+        self.n_neighbors = np.zeros(capacity, dtype=int)  # the number of possible relays
+        self.relay_speeds = np.zeros(capacity, dtype=float)
+        self.relay_coords = np.zeros((capacity, 2), dtype=float)
+
+        self.free_slots = list(reversed(range(capacity)))
+        self.event_slots = {}  # { event id : set of the slots of the actions taken for the event }
+
+    def take_action(self, slot, event_id, state, action, n_neighbors, relay_speed, relay_coords):
+        """ record the action in the slot, a new one if slot is None, and return the slot """
+        if slot is None:
+            if not self.free_slots:
+                self.__grow()
+            slot = self.free_slots.pop()
+            self.event_slots.setdefault(event_id, set()).add(slot)
+
+        self.states[slot] = state
+        self.actions[slot] = action
+        self.n_neighbors[slot] = n_neighbors
+        self.relay_speeds[slot] = relay_speed
+        self.relay_coords[slot] = relay_coords
+        return slot
+
+    def slots_of(self, event_id):
+        """ the slots of the actions taken for the event, in the order of the drones that took them """
+        event_slots = self.event_slots.get(event_id)
+        if event_slots is None:
+            return np.zeros(0, dtype=int)
+
+        slots = np.fromiter(event_slots, dtype=int, count=len(event_slots))
+        return slots[np.argsort(self.states[slots], kind="stable")]
+
+    def release(self, event_id, slots):
+        """ free the slots of the actions taken for the event that got their feedback """
+        event_slots = self.event_slots[event_id]
+        for slot in slots:
+            event_slots.discard(int(slot))
+            self.free_slots.append(int(slot))
+        if len(event_slots) == 0:
+            del self.event_slots[event_id]
+
+    def bellman_update(self, slots, rewards):
+        """
+        Q[s, a] = (1 - LEARNING_RATE) * Q[s, a] + LEARNING_RATE * (reward + DISCOUNT_FACTOR * max(Q[a]))
+        for all the slots, as if they were applied one at a time in the order of slots: an update reads the
+        row of the relay after the updates of the drones that come before it, and before those of the
+        drones that come after it. The updates are grouped in rounds that respect this order and every
+        round is applied at once.
+        @param slots: the slots, in the order of their states, there is at most one slot per drone
+        @param rewards: the reward of every slot
+        """
+        states = self.states[slots]
+        actions = self.actions[slots]
+        rewards = np.asarray(rewards, dtype=float)
+
+        rounds = np.zeros(len(slots), dtype=int)
+        write_round = {}  # { row : the round in which it is written }
+        read_round = {}  # { row : the latest round in which it is read }
+        for i, (state, action) in enumerate(zip(states.tolist(), actions.tolist())):
+            # after the update of the relay row, if it comes before, and not before the reads of the own row
+            round_i = max(write_round[action] + 1 if action in write_round else 0, read_round.get(state, 0))
+            rounds[i] = round_i
+            write_round[state] = round_i
+            read_round[action] = max(read_round.get(action, 0), round_i)
+
+        for round_i in range(rounds.max(initial=-1) + 1):
+            in_round = rounds == round_i
+            round_states, round_actions = states[in_round], actions[in_round]
+
+            max_relay_q = self.q[round_actions].max(axis=1)
+            self.q[round_states, round_actions] = (1 - LEARNING_RATE) * self.q[round_states, round_actions] + \
+                LEARNING_RATE * (rewards[in_round] + (DISCOUNT_FACTOR * max_relay_q))
+
+    def __grow(self):
+        """ double the number of slots """
+        capacity = len(self.states)
+        self.states = np.resize(self.states, 2 * capacity)
+        self.actions = np.resize(self.actions, 2 * capacity)
+        self.n_neighbors = np.resize(self.n_neighbors, 2 * capacity)
+        self.relay_speeds = np.resize(self.relay_speeds, 2 * capacity)
+        self.relay_coords = np.resize(self.relay_coords, (2 * capacity, 2))
+        self.free_slots.extend(reversed(range(capacity, 2 * capacity)))
+
+
 class QLearningRouting(BASE_routing):
 
     def __init__(self, drone, simulator):
         BASE_routing.__init__(self, entity=drone, simulator=simulator)
-        self.taken_actions = {}  # id event : (old_state, old_action)
+        self.taken_actions = {}  # id event : slot of the action in the SwarmQTable
 
         # state: the current drone
         # actions: all drones in the simulation
-        self.qtable = [0 for _ in range(self.simulator.n_drones)]
+        # the qtable of a drone is its row of the swarm matrix, the depot has a qtable of its own never updated
+        self.swarm_qtable = self.simulator.swarm_qtable
+        if isinstance(drone, Depot):
+            self.qtable = np.zeros(self.simulator.n_drones, dtype=float)
+        else:
+            self.qtable = self.swarm_qtable.q[drone.identifier]
 
         # this structure is used to store the delivery ratio of each drone,
         # the ratio will be used for calculate the link quality
@@ -40,102 +172,124 @@ class QLearningRouting(BASE_routing):
         }
 
         # link_quality associates a list of values with a specific drone,
-        # this values 
+        # this values are averaged on at most one per neighbor, no more than n_drones are kept
         self.link_quality = dict()
 
-        random.seed(self.simulator.seed)
+        # (speed, coords) of the possible relays and of the drone itself, by drone identifier,
+        # built once for all the packets routed in a send_packets call
+        self.neighbors_info = {}
+        self.neighbors_info_of = None  # the opt_neighbors neighbors_info was built from
+
+        # the exploration draws come from the random module when the drones share the streams
+        if self.simulator.random_streams == config.RandomStreams.SHARED:
+            random.seed(self.simulator.seed)
+            self.rnd_exploration = random
+        else:
+            self.rnd_exploration = self.rnd
         self.random_routing = RND(self.entity, self.simulator)
 
-    def feedback(self, drone, id_event, delay, outcome):
+    @classmethod
+    def batch_feedback(cls, simulator, drone, id_event, delay, outcome):
         """
-        Feedback returned when the packet arrives at the depot or
-        Expire. This function have to be implemented in RL-based protocols ONLY
+        Feedback returned when the packet arrives at the depot or expires, to all the drones that took an
+        action for it. The rewards are computed drone by drone, the Bellman updates all together.
+        @param simulator: the simulator
         @param drone: The drone that holds the packet
         @param id_event: The Event id
         @param delay: packet delay
         @param outcome: -1 or 1 (read below)
         @return:
         """
+        with simulator.profiler.phase("routing.feedback"):
+            swarm_qtable = simulator.swarm_qtable
+            if id_event not in swarm_qtable.event_slots:
+                return
 
-        if id_event in self.taken_actions:
-            state = self.taken_actions[id_event]["state"]
-            action = self.taken_actions[id_event]["action"]
-            num_of_neighbors = self.taken_actions[id_event]["len_opt_neighbors"]
-            action_qtable = self.taken_actions[id_event]["current_state"]
-            relay_speed = self.taken_actions[id_event]["relay_speed"]
-            relay_coords = self.taken_actions[id_event]["relay_coords"]
-
-            #print(f"[QL] Sono il drone {self.entity} - {state} ho inviato a {action} - outcome: {outcome} - drone: {drone}\nneighbor table: {self.entity.neighbor_table}\nqtable: {self.qtable}")
+            slots = swarm_qtable.slots_of(id_event)
 
-            self.delivery_ratio[action.identifier]["all_packets"] += 1    
-            if outcome == 1:
-                self.delivery_ratio[action.identifier]["packets_to_depot"] += 1
+            rewards = []
+            for slot in slots:
+                routing_algorithm = simulator.drones[swarm_qtable.states[slot]].routing_algorithm
+                rewards.append(routing_algorithm.__reward(slot, drone, outcome))
+                del routing_algorithm.taken_actions[id_event]
 
-            #if action == drone:
-            
-            link_stability = None
-            if action in state.neighbor_table:
-                delivery_ratio = self.delivery_ratio[action.identifier]["packets_to_depot"] / self.delivery_ratio[action.identifier]["all_packets"]
+            swarm_qtable.bellman_update(slots, rewards)
+            swarm_qtable.release(id_event, slots)
 
-                #print(f"[INFO] Il mio delivery ratio verso il drone {action} -> {delivery_ratio} - il dr varrà {(1 - LINK_QUALITY_ALPHA) * delivery_ratio}")
+    def __reward(self, slot, drone, outcome):
+        """ the reward of the action in the slot, it updates the delivery ratio and the link quality """
+        state = self.entity
+        action = self.simulator.drones[self.swarm_qtable.actions[slot]]
+        num_of_neighbors = int(self.swarm_qtable.n_neighbors[slot])
+        relay_speed = float(self.swarm_qtable.relay_speeds[slot])
+        relay_coords = tuple(self.swarm_qtable.relay_coords[slot].tolist())
 
-                src_drone_speed = state.speed
-                dst_drone_speed = relay_speed
-                speed_move_away = min(src_drone_speed, dst_drone_speed) / max(src_drone_speed, dst_drone_speed)
+        #print(f"[QL] Sono il drone {self.entity} - {state} ho inviato a {action} - outcome: {outcome} - drone: {drone}\nneighbor table: {self.entity.neighbor_table}\nqtable: {self.qtable}")
 
-                #print(f"[INFO] La mia speed_move_away verso il drone {action} -> {speed_move_away} - nel ls varrà {(1 - WEIGHT_VALUE) * math.exp(1 / speed_move_away)}")
+        self.delivery_ratio[action.identifier]["all_packets"] += 1    
+        if outcome == 1:
+            self.delivery_ratio[action.identifier]["packets_to_depot"] += 1
 
-                if action.identifier not in self.link_quality:
-                    self.link_quality[action.identifier] = [(1 - LINK_QUALITY_ALPHA) * delivery_ratio]
-                else:
-                    self.link_quality[action.identifier].append((self.link_quality[action.identifier][-1] * LINK_QUALITY_ALPHA) + ((1 - LINK_QUALITY_ALPHA) * delivery_ratio))
-
-                #print(f"[INFO] Link quality settato nei confronti del drone {action} -> {self.link_quality[action.identifier][-1]} - il lq precedente varrà {self.link_quality[action.identifier][-1] * LINK_QUALITY_ALPHA}")
+        #if action == drone:
+            
+        link_stability = None
+        if action in state.neighbor_table:
+            delivery_ratio = self.delivery_ratio[action.identifier]["packets_to_depot"] / self.delivery_ratio[action.identifier]["all_packets"]
 
-                truncated_link_quality = self.link_quality[action.identifier].copy()[:-1]
-                if len(truncated_link_quality) > num_of_neighbors:
-                    truncated_link_quality = truncated_link_quality[-num_of_neighbors:]
+            #print(f"[INFO] Il mio delivery ratio verso il drone {action} -> {delivery_ratio} - il dr varrà {(1 - LINK_QUALITY_ALPHA) * delivery_ratio}")
 
-                #print(f"[INFO] Sum di truncated link quality varrà {sum(truncated_link_quality)} - IL valore varrà {WEIGHT_VALUE * ((sum(truncated_link_quality)) / (num_of_neighbors))}")
+            src_drone_speed = state.speed
+            dst_drone_speed = relay_speed
+            speed_move_away = min(src_drone_speed, dst_drone_speed) / max(src_drone_speed, dst_drone_speed)
 
-                link_stability = (1 - WEIGHT_VALUE) * math.exp(1 / speed_move_away) + \
-                    WEIGHT_VALUE * ((sum(truncated_link_quality)) / (num_of_neighbors))
+            #print(f"[INFO] La mia speed_move_away verso il drone {action} -> {speed_move_away} - nel ls varrà {(1 - WEIGHT_VALUE) * math.exp(1 / speed_move_away)}")
 
-            reward = 0
-            if outcome == 1 and action == drone:
-                reward = MAX_VALUE
-                #print("[INFO] Reward 1 caso")
+            if action.identifier not in self.link_quality:
+                self.link_quality[action.identifier] = LinkQualityWindow(self.simulator.n_drones)
+                self.link_quality[action.identifier].append((1 - LINK_QUALITY_ALPHA) * delivery_ratio)
             else:
-                if util.euclidean_distance(self.simulator.depot.coords, state.coords) < util.euclidean_distance(self.simulator.depot.coords, relay_coords):
-                    reward = MIN_VALUE
-                    #print("[INFO] Reward 2 caso")
-                elif link_stability is not None:
-                    hops_count = [state.neighbor_table[drone]["hop_count_from_CC"] for drone in state.neighbor_table]
-
-                    if hops_count == []:
-                        reward = (1 - WEIGHTING_FACTOR) * link_stability
-                        #print("[INFO] Reward 3 caso")
-                    else:
-                        reward = WEIGHTING_FACTOR * math.exp(1 / min(hops_count)) + (1 - WEIGHTING_FACTOR) * link_stability
-                        #print(f"[INFO] Reward 4 caso - {WEIGHTING_FACTOR * math.exp(1 / min(hops_count))} + {(1 - WEIGHTING_FACTOR) * link_stability}")
-                else:
-                    reward = MAX_VALUE
+                self.link_quality[action.identifier].append((self.link_quality[action.identifier].last() * LINK_QUALITY_ALPHA) + ((1 - LINK_QUALITY_ALPHA) * delivery_ratio))
 
-                    #print(f"[INFO] Reward 5 caso - reward: {reward}")
+            #print(f"[INFO] Link quality settato nei confronti del drone {action} -> {self.link_quality[action.identifier].last()}")
 
-            #print(f"[INFO] Reward: {reward}")
+            # the previous values, at most one per neighbor
+            truncated_link_quality = self.link_quality[action.identifier].sum_before_last(num_of_neighbors)
 
-            #self.qtable[action.identifier] = (1 - LEARNING_RATE) * self.qtable[action.identifier] + \
-            #    LEARNING_RATE * (reward + (DISCOUNT_FACTOR * max(action_qtable)))
+            #print(f"[INFO] Sum di truncated link quality varrà {truncated_link_quality} - IL valore varrà {WEIGHT_VALUE * (truncated_link_quality / (num_of_neighbors))}")
 
-            self.qtable[action.identifier] = (1 - LEARNING_RATE) * self.qtable[action.identifier] + \
-                LEARNING_RATE * (reward + (DISCOUNT_FACTOR * max(action_qtable)))
+            link_stability = (1 - WEIGHT_VALUE) * math.exp(1 / speed_move_away) + \
+                WEIGHT_VALUE * (truncated_link_quality / (num_of_neighbors))
 
-            #print(f"[OUTCOME] QTable: {self.qtable}")
+        reward = 0
+        if outcome == 1 and action == drone:
+            reward = MAX_VALUE
+            #print("[INFO] Reward 1 caso")
+        else:
+            if self.simulator.distance_matrix.depot_distance(state) < util.euclidean_distance(self.simulator.depot.coords, relay_coords):
+                reward = MIN_VALUE
+                #print("[INFO] Reward 2 caso")
+            elif link_stability is not None:
+                hops_count = [state.neighbor_table[drone]["hop_count_from_CC"] for drone in state.neighbor_table]
+
+                if hops_count == []:
+                    reward = (1 - WEIGHTING_FACTOR) * link_stability
+                    #print("[INFO] Reward 3 caso")
+                else:
+                    reward = WEIGHTING_FACTOR * math.exp(1 / min(hops_count)) + (1 - WEIGHTING_FACTOR) * link_stability
+                    #print(f"[INFO] Reward 4 caso - {WEIGHTING_FACTOR * math.exp(1 / min(hops_count))} + {(1 - WEIGHTING_FACTOR) * link_stability}")
+            else:
+                reward = MAX_VALUE
 
-            del self.taken_actions[id_event]
+                #print(f"[INFO] Reward 5 caso - reward: {reward}")
 
-            #input()
+        #print(f"[INFO] Reward: {reward}")
+        return reward
+
+    def prepare_relay_selection(self, opt_neighbors):
+        """ collect the speed and the position of the possible relays, for all the packets of the buffer """
+        self.neighbors_info = {drone.identifier: (pck.speed, pck.cur_pos) for pck, drone in opt_neighbors}
+        self.neighbors_info[self.entity.identifier] = (self.entity.speed, self.entity.coords)
+        self.neighbors_info_of = opt_neighbors
 
     def relay_selection(self, opt_neighbors: list, packet):
         """
@@ -148,22 +302,11 @@ class QLearningRouting(BASE_routing):
 
         # info structure used to store many information about the
         # current drone and the neighbor drones
-        #  
-        info = {
-            drone: {
-                "coords": pck.cur_pos,
-                "speed": pck.speed,
-                "relay_qtable": pck.optional_data["relay_qtable"]
-            } for pck, drone in opt_neighbors
-        }
+        if self.neighbors_info_of is not opt_neighbors:
+            self.prepare_relay_selection(opt_neighbors)
+        info = self.neighbors_info
 
-        info[self.entity] = {
-            "coords": self.entity.coords,
-            "speed": self.entity.speed,
-            "relay_qtable": self.qtable
-        }
-
-        probability = random.random()
+        probability = self.rnd_exploration.random()
         # do exploration
         if probability < PROBABILITY_OF_EXPLORATION:
             # removes from opt_neighbors all nodes for which knowledge already exists 
@@ -192,13 +335,20 @@ class QLearningRouting(BASE_routing):
         path.append(relay)
         """
 
-        self.taken_actions[packet.event_ref.identifier] = {
-            "state": state,
-            "action": action,
-            "len_opt_neighbors": len(opt_neighbors),
-            "current_state": info[relay]["relay_qtable"],
-            "relay_speed": info[relay]["speed"],
-            "relay_coords": info[relay]["coords"],
-        }
-
-        return relay  
\ No newline at end of file
+        # the relay qtable, needed by the feedback, is the row of the relay in the swarm matrix
+        relay_speed, relay_coords = info[relay.identifier]
+        self.apply_effect(self.__take_action,
+                          packet.event_ref.identifier,
+                          state.identifier,
+                          action.identifier,
+                          len(opt_neighbors),
+                          relay_speed,
+                          relay_coords)
+
+        return relay
+
+    def __take_action(self, event_id, state_id, action_id, n_neighbors, relay_speed, relay_coords):
+        """ record in the swarm qtable the action taken for the packet of the event """
+        self.taken_actions[event_id] = self.swarm_qtable.take_action(self.taken_actions.get(event_id), event_id,
+                                                                     state_id, action_id, n_neighbors,
+                                                                     relay_speed, relay_coords)  
\ No newline at end of file
@@ -15,4 +15,4 @@ class RandomRouting(BASE_routing):
         @return: a random drone as relay
         """
 
-        return self.simulator.rnd_routing.choice([v[1] for v in opt_neighbors])
+        return self.rnd.choice([v[1] for v in opt_neighbors])
@@ -15,14 +15,52 @@ from src.utilities import config
 """ Metrics class keeps track of all the metrics during all the simulation. """
 
 
+class ColumnarBuffer:
+    """ Append-only table, every column is a preallocated numpy array whose capacity doubles when it is full. """
+
+    def __init__(self, columns: dict, capacity=1024):
+        """
+        @param columns: dictionary { column name : numpy dtype }
+        @param capacity: the initial number of rows
+        """
+        self.capacity = capacity
+        self.size = 0
+        self.columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in columns.items()}
+
+    def append(self, *values):
+        """ add a row, values are in the order of the columns. Return the index of the row. """
+        if self.size == self.capacity:
+            self.capacity *= 2
+            for name, column in self.columns.items():
+                self.columns[name] = np.resize(column, self.capacity)
+
+        for column, value in zip(self.columns.values(), values):
+            column[self.size] = value
+
+        self.size += 1
+        return self.size - 1
+
+    def column(self, name):
+        """ the filled part of the column """
+        return self.columns[name][:self.size]
+
+    def __len__(self):
+        return self.size
+
+
 class Metrics:
 
     def __init__(self, simulator):
 
         self.simulator = simulator
 
-        # The mean number of possible relays when i want to communicate
-        self.mean_numbers_of_possible_relays = []
+        # if true, packets and events are recorded as compact rows instead of keeping the objects alive
+        self.streaming = simulator.streaming_metrics
+
+        # The number of possible relays when i want to communicate, summed over all the routed packets,
+        # and the number of routed packets: their ratio is the mean number of relays
+        self.sum_of_possible_relays = 0
+        self.number_of_relay_selections = 0
 
         # all packets in the simulation
         self.all_control_packets_in_simulation = 0
@@ -53,12 +91,108 @@ class Metrics:
 
         self.time_on_active_routing = 0
 
+        if self.streaming:
+            self.__init_streaming()
+
+    def __init_streaming(self):
+        """ the rows used in place of the sets and lists of objects """
+        # the coordinates are kept as the tuples of the entities, so that they are saved as in the default mode.
+        # min_delivery_delay is -1 for the events not delivered
+        self.event_rows = ColumnarBuffer({"id": np.int64, "coord": object, "i_gen": np.int64,
+                                          "i_dead": np.int64, "detected": bool, "min_delivery_delay": np.int64})
+        self.not_listened_event_rows = ColumnarBuffer({"id": np.int64, "coord": object,
+                                                       "i_gen": np.int64, "i_dead": np.int64})
+        # info is the one of the DPACKPacket, None for the other packets
+        self.packet_rows = ColumnarBuffer({"id": np.int64, "id_event": np.int64, "coord": object,
+                                           "i_gen": np.int64, "i_dead": np.int64, "TTL": np.int64,
+                                           "info": object})
+        self.packet_to_depot_rows = ColumnarBuffer({"id": np.int64, "id_event": np.int64, "coord": object,
+                                                    "i_gen": np.int64, "i_dead": np.int64, "TTL": np.int64,
+                                                    "delivery_ts": np.int64})
+
+        self.__event_row = {}  # { event id : row in event_rows }, the ids of the live events are unique
+        self.__delivered_at_step = (None, set())  # (step, packets ids) to drop duplicated deliveries
+        self.__deliveries = 0  # deliveries to the depot, duplicates included
+        self.__packet_delivery_times_sum = 0
+
+    # ------------------ recording ----------------------
+    def record_event(self, event):
+        """ an event was generated """
+        if not self.streaming:
+            self.events.add(event)
+            return
+
+        self.__event_row[event.identifier] = self.event_rows.append(
+            event.identifier, event.coords, event.current_time, event.deadline, False, -1)
+
+    def record_not_listened_event(self, event):
+        """ an event was missed because the drone was doing movement routing """
+        if not self.streaming:
+            self.events_not_listened.add(event)
+            return
+
+        self.not_listened_event_rows.append(event.identifier, event.coords, event.current_time, event.deadline)
+
+    def record_packet(self, packet):
+        """ a packet of an event was created, return its row (None if not streaming) """
+        if not self.streaming:
+            self.drones_packets.add(packet)
+            return None
+
+        event = packet.event_ref
+        self.event_rows.columns["detected"][self.__event_row[event.identifier]] = True
+        return self.packet_rows.append(packet.identifier, event.identifier, packet.coords,
+                                       packet.time_step_creation, event.deadline, packet.get_TTL(), None)
+
+    def record_packet_hop(self, packet_row, ttl):
+        """ keep the TTL of a recorded packet up to date """
+        self.packet_rows.columns["TTL"][packet_row] = ttl
+
+    def record_packet_info(self, packet_row, info):
+        """ the info of a recorded DPACKPacket, saved as in its to_json """
+        self.packet_rows.columns["info"][packet_row] = info
+
+    def record_packet_to_depot(self, packet, cur_step):
+        """ a packet was notified to the depot """
+        if not self.streaming:
+            self.drones_packets_to_depot.add((packet, cur_step))
+            self.drones_packets_to_depot_list.append((packet, cur_step))
+            return
+
+        self.__deliveries += 1
+
+        # the same packet delivered twice in the same step is counted once, as with the set of (packet, step)
+        step, delivered = self.__delivered_at_step
+        if step != cur_step:
+            delivered = set()
+            self.__delivered_at_step = (cur_step, delivered)
+        if packet.identifier in delivered:
+            return
+        delivered.add(packet.identifier)
+
+        event = packet.event_ref
+        self.packet_to_depot_rows.append(packet.identifier, event.identifier, packet.coords,
+                                         packet.time_step_creation, event.deadline, packet.get_TTL(), cur_step)
+        self.__packet_delivery_times_sum += cur_step - packet.time_step_creation
+
+        event_row = self.__event_row[event.identifier]
+        min_delays = self.event_rows.columns["min_delivery_delay"]
+        delay = cur_step - event.current_time
+        if min_delays[event_row] == -1 or delay < min_delays[event_row]:
+            min_delays[event_row] = delay
+
+    def number_of_deliveries(self):
+        """ the number of packets notified to the depot, duplicates included """
+        return self.__deliveries if self.streaming else len(self.drones_packets_to_depot_list)
 
     def other_metrics(self):
         """
         Post-execution metrics
         @return: None
         """
+        if self.streaming:
+            self.__streaming_other_metrics()
+            return
 
         # the number of all the events generated during the simulation
         self.number_of_generated_events = len(self.events)
@@ -101,6 +235,71 @@ class Metrics:
         self.packet_mean_delivery_time = np.mean(packet_delivery_times) * self.simulator.time_step_duration
         self.event_mean_delivery_time = np.mean(event_delivery_times) * self.simulator.time_step_duration
 
+    def __streaming_other_metrics(self):
+        """ the post-execution metrics out of the rows, the delays were accumulated during the simulation """
+        self.number_of_generated_events = len(self.event_rows)
+        self.number_of_not_generated_events = len(self.not_listened_event_rows)
+        self.number_of_detected_events = int(np.count_nonzero(self.event_rows.column("detected")))
+
+        # the delivered events in the order of the default mode: the set of the events of the packets, taken
+        # in the order of the set of the packets notified to the depot
+        to_depot_order = self.__set_order(self.__to_depot_keys())
+        event_ids = self.packet_to_depot_rows.column("id_event").tolist()
+        coords = self.packet_to_depot_rows.column("coord").tolist()
+        delivered_events = [(event_ids[i], coords[i]) for i in to_depot_order]
+        delivered_events = [delivered_events[i] for i in self.__set_order(delivered_events)]
+
+        min_delays = self.event_rows.column("min_delivery_delay")
+        event_delivery_times = [min_delays[self.__event_row[event_id]] for event_id, _ in delivered_events]
+
+        self.number_of_events_to_depot = len(event_delivery_times)
+        self.number_of_packets_to_depot = len(self.packet_to_depot_rows)
+
+        self.event_delivery_times = event_delivery_times
+        if self.number_of_packets_to_depot > 0:
+            self.packet_mean_delivery_time = (self.__packet_delivery_times_sum / self.number_of_packets_to_depot
+                                              * self.simulator.time_step_duration)
+        else:
+            self.packet_mean_delivery_time = np.nan
+        self.event_mean_delivery_time = np.mean(event_delivery_times) * self.simulator.time_step_duration
+
+    @staticmethod
+    def __set_order(keys):
+        """ the indices of keys, in the order in which a set of the keys added one by one is iterated. An Entity is
+            hashed as (identifier, coords), so it is also the order of the sets of entities of the default mode.
+        """
+        first_index = {}
+        for i, key in enumerate(keys):
+            first_index.setdefault(key, i)
+        return [first_index[key] for key in set(keys)]
+
+    @staticmethod
+    def __entity_keys(rows: ColumnarBuffer):
+        """ the (identifier, coords) of every row, the hash of the entity of the row """
+        return list(zip(rows.column("id").tolist(), rows.column("coord").tolist()))
+
+    def __to_depot_keys(self):
+        """ the (packet, delivery step) of every row of the packets notified to the depot, as hashed in the
+            default mode
+        """
+        return list(zip(self.__entity_keys(self.packet_to_depot_rows),
+                        self.packet_to_depot_rows.column("delivery_ts").tolist()))
+
+    @staticmethod
+    def __rows_to_json(rows: ColumnarBuffer, keys, order):
+        """ the json repr of the rows in order, as the to_json of the objects they replace """
+        columns = {name: rows.column(name).tolist() for name in rows.columns}
+        infos = columns.get("info")
+        out = []
+        for i in order:
+            row = {"coord": columns["coord"][i]}
+            # as DPACKPacket.to_json
+            row_keys = ["i_gen", "i_dead", "id", "id_event", "info"] if infos and infos[i] is not None else keys
+            for key in row_keys:
+                row[key] = columns[key][i]
+            out.append(row)
+        return out
+
     def print_overall_stats(self):
         """
         print the overall stats of the alg execution
@@ -108,7 +307,7 @@ class Metrics:
         """
         self.other_metrics()
         print(f"*** Relays ***")
-        print("Mean number of relays: ", np.nanmean(self.mean_numbers_of_possible_relays))
+        print("Mean number of relays: ", self.mean_number_of_relays())
 
         print(f"*** Events ***")
         print("Number of generated events: ", self.number_of_generated_events)
@@ -128,9 +327,9 @@ class Metrics:
             print("NeighborTable packets sent during the simulation: ", self.all_neighbor_table_packets_in_simulation)
             print()
             
-        print("Number of packets to depot: ", len(self.drones_packets_to_depot_list))
+        print("Number of packets to depot: ", self.number_of_deliveries())
         print("Packet mean delivery time (seconds): ", self.packet_mean_delivery_time)
-        print("Packet delivery ratio: ", len(self.drones_packets_to_depot_list)/self.all_data_packets_in_simulation)
+        print("Packet delivery ratio: ", self.number_of_deliveries()/self.all_data_packets_in_simulation)
 
     def info_mission(self):
         """
@@ -183,15 +382,43 @@ class Metrics:
         out_results["all_discovery_packets_sent"] = self.all_discovery_packets_sent
         out_results["all_dpack_packets_in_simulation"] = self.all_dpack_packets_in_simulation
         out_results["all_neighbor_table_packets_in_simulation"] = self.all_neighbor_table_packets_in_simulation
-        out_results["all_events"] = [ev.to_json() for ev in self.events]
-        out_results["not_listened_events"] = [ev.to_json() for ev in self.events_not_listened]
         out_results["events_delivery_times"] = [str(e) for e in self.event_delivery_times]
-        out_results["drones_packets"] = [pck.to_json() for pck in self.drones_packets]
-        out_results["drones_to_depot_packets"] = [(pck.to_json(), delivery_ts) for pck, delivery_ts in self.drones_packets_to_depot]
-        out_results["mean_number_of_relays"] = np.nanmean(self.mean_numbers_of_possible_relays)
+        if self.streaming:
+            event_keys = ["i_gen", "i_dead", "id"]
+            packet_keys = ["i_gen", "i_dead", "id", "TTL", "id_event"]
+            # in the order of the sets of the default mode
+            out_results["all_events"] = self.__rows_to_json(
+                self.event_rows, event_keys, self.__set_order(self.__entity_keys(self.event_rows)))
+            out_results["not_listened_events"] = self.__rows_to_json(
+                self.not_listened_event_rows, event_keys,
+                self.__set_order(self.__entity_keys(self.not_listened_event_rows)))
+            out_results["drones_packets"] = self.__rows_to_json(
+                self.packet_rows, packet_keys, self.__set_order(self.__entity_keys(self.packet_rows)))
+            to_depot_order = self.__set_order(self.__to_depot_keys())
+            delivery_steps = self.packet_to_depot_rows.column("delivery_ts").tolist()
+            out_results["drones_to_depot_packets"] = [
+                (pck, delivery_steps[i]) for pck, i in zip(self.__rows_to_json(self.packet_to_depot_rows, packet_keys,
+                                                                                to_depot_order), to_depot_order)]
+        else:
+            out_results["all_events"] = [ev.to_json() for ev in self.events]
+            out_results["not_listened_events"] = [ev.to_json() for ev in self.events_not_listened]
+            out_results["drones_packets"] = [pck.to_json() for pck in self.drones_packets]
+            out_results["drones_to_depot_packets"] = [(pck.to_json(), delivery_ts) for pck, delivery_ts in self.drones_packets_to_depot]
+        out_results["mean_number_of_relays"] = self.mean_number_of_relays()
 
         return out_results
 
+    def record_possible_relays(self, n_relays, n_packets):
+        """ n_packets packets are going to be routed, each one with n_relays possible relays """
+        self.sum_of_possible_relays += n_relays * n_packets
+        self.number_of_relay_selections += n_packets
+
+    def mean_number_of_relays(self):
+        """ the mean number of possible relays of the routed packets, nan if no packet was routed """
+        if self.number_of_relay_selections == 0:
+            return np.nan
+        return self.sum_of_possible_relays / self.number_of_relay_selections
+
     def save(self, filename):
         """ save the metrics on file """
         with open(filename, 'wb') as out:
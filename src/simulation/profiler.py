@@ -0,0 +1,121 @@
+from collections import defaultdict
+from contextlib import nullcontext
+import cProfile
+import pstats
+import json
+import time
+
+"""
+This file contains the PhaseProfiler, the opt-in instrumentation of Simulator.run: it accumulates the wall time
+and the number of calls of every phase of the step and of the main methods of the routing algorithms.
+"""
+
+# returned by a disabled profiler, entering it does nothing
+_NO_PHASE = nullcontext()
+
+
+class _Phase:
+    """ Context manager that adds the time spent in its body to a phase of the profiler, it can be nested. """
+
+    def __init__(self, seconds, calls, name):
+        self.seconds = seconds
+        self.calls = calls
+        self.name = name
+        self.starts = []
+
+    def __enter__(self):
+        self.starts.append(time.perf_counter())
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds[self.name] += time.perf_counter() - self.starts.pop()
+        self.calls[self.name] += 1
+
+
+class PhaseProfiler:
+    """ Accumulates wall time and call counts per phase of Simulator.run. When disabled, phase() returns a
+        context manager that does nothing and the routing algorithms are not touched.
+        Optionally, the steps in [capture_steps[0], capture_steps[1]) are captured with cProfile.
+    """
+
+    def __init__(self, enabled=False, capture_steps=None):
+        self.enabled = enabled
+        self.capture_steps = capture_steps
+        self.seconds = defaultdict(float)  # { phase : seconds }
+        self.calls = defaultdict(int)  # { phase : number of calls }
+        self.__phases = {}  # { phase : _Phase }, reused at every call
+        self.__capture = None  # the cProfile.Profile of the capture window
+
+    def phase(self, name):
+        """ the context manager to wrap the code of the phase name with """
+        if not self.enabled:
+            return _NO_PHASE
+
+        phase = self.__phases.get(name)
+        if phase is None:
+            phase = self.__phases[name] = _Phase(self.seconds, self.calls, name)
+        return phase
+
+    def instrument_routing(self, entities):
+        """ wrap relay_selection and drone_reception (by packet type) of the routing algorithms, the feedback
+            of QLearningRouting is timed as the phase routing.feedback
+        """
+        if not self.enabled:
+            return
+
+        for entity in entities:
+            routing_algorithm = entity.routing_algorithm
+            routing_algorithm.relay_selection = self.__timed("routing.relay_selection",
+                                                             routing_algorithm.relay_selection)
+            routing_algorithm.drone_reception = self.__timed_reception(routing_algorithm.drone_reception)
+
+    def __timed(self, name, method):
+        phase = self.phase(name)
+
+        def timed_method(*args, **kwargs):
+            with phase:
+                return method(*args, **kwargs)
+
+        return timed_method
+
+    def __timed_reception(self, drone_reception):
+        def timed_drone_reception(src_entity, packet, current_ts):
+            with self.phase("routing.drone_reception." + type(packet).__name__):
+                return drone_reception(src_entity, packet, current_ts)
+
+        return timed_drone_reception
+
+    def begin_step(self, cur_step):
+        """ start the cProfile capture at the first step of the window """
+        if self.capture_steps is not None and cur_step == self.capture_steps[0]:
+            self.__capture = cProfile.Profile()
+            self.__capture.enable()
+
+    def end_step(self, cur_step):
+        """ stop the cProfile capture after the last step of the window """
+        if self.__capture is not None and cur_step == self.capture_steps[1] - 1:
+            self.__capture.disable()
+
+    def end_run(self):
+        """ stop the cProfile capture if the simulation ended before the end of the window """
+        if self.__capture is not None:
+            self.__capture.disable()
+
+    def summary(self):
+        """ { phase : {"seconds": ..., "calls": ...} }, the most expensive phases first """
+        return {name: {"seconds": self.seconds[name], "calls": self.calls[name]}
+                for name in sorted(self.seconds, key=self.seconds.get, reverse=True)}
+
+    def print_summary(self):
+        """ print the time of every phase """
+        print("Phase profile (seconds, calls):")
+        for name, phase in self.summary().items():
+            print(f"\t{name}: {phase['seconds']:.3f} s, {phase['calls']}")
+
+    def save(self, filename_path):
+        """ save the summary in filename_path + "_profile.json" and the capture in filename_path + ".pstats" """
+        if self.enabled:
+            with open(filename_path + "_profile.json", "w") as profile_file:
+                json.dump(self.summary(), profile_file, indent=2)
+
+        if self.__capture is not None:
+            pstats.Stats(self.__capture).dump_stats(filename_path + ".pstats")
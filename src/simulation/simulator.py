@@ -1,12 +1,16 @@
 from src.drawing import pp_draw
 from src.entities.uav_entities import *
 from src.simulation.metrics import Metrics
+from src.simulation.spatial import NeighborGrid, SwarmPositions, DistanceMatrix, CellProbabilityMap
+from src.simulation.profiler import PhaseProfiler
 from src.utilities import config, utilities
 from src.routing_algorithms.net_routing import MediumDispatcher
-from collections import defaultdict
+from src.routing_algorithms.q_learning_routing import SwarmQTable
 from tqdm import tqdm
 
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import itertools
 import math
 import time
 
@@ -45,6 +49,15 @@ class Simulator:
                  routing_algorithm=config.ROUTING_ALGORITHM,
                  communication_error_type=config.CHANNEL_ERROR_TYPE,
                  prob_size_cell_r=config.CELL_PROB_SIZE_R,
+                 vectorized_movement=config.VECTORIZED_MOVEMENT,
+                 synchronous_step=config.SYNCHRONOUS_STEP,
+                 step_workers=config.STEP_WORKERS,
+                 event_driven=config.EVENT_DRIVEN,
+                 streaming_metrics=config.STREAMING_METRICS,
+                 packets_pool=config.PACKETS_POOL,
+                 random_streams=config.RANDOM_STREAMS,
+                 profile_phases=config.PROFILE_PHASES,
+                 profile_capture_steps=config.PROFILE_CAPTURE_STEPS,
                  simulation_name=""):
         self.cur_step = None
         self.drone_com_range = drone_com_range
@@ -72,11 +85,19 @@ class Simulator:
         self.show_plot = show_plot
         self.routing_algorithm = routing_algorithm
         self.communication_error_type = communication_error_type
+        self.vectorized_movement = vectorized_movement
+        self.synchronous_step = synchronous_step
+        self.step_workers = step_workers
+        self.__step_executor = None  # the threads of the synchronous step, when step_workers > 1
+        self.event_driven = event_driven
+        self.__buffered_drones = []  # the drones with packets after the last complete step, see __next_wake_step
+        self.streaming_metrics = streaming_metrics
+        self.profiler = PhaseProfiler(profile_phases, profile_capture_steps)
 
         # --------------- cell for drones -------------
         self.prob_size_cell_r = prob_size_cell_r
         self.prob_size_cell = int(self.drone_com_range * self.prob_size_cell_r)
-        self.cell_prob_map = defaultdict(lambda: [0, 0, 0])
+        self.cell_prob_map = CellProbabilityMap(self.env_width, self.env_height, self.prob_size_cell)
 
         self.sim_save_file = config.SAVE_PLOT_DIR + self.__sim_name()
         self.path_to_depot = None
@@ -84,6 +105,20 @@ class Simulator:
         # Setup vari
         self.__set_stepwise_discovery_mode()
 
+        # the ids of the depot, the events and the packets, after those of the drones
+        self.entity_ids = itertools.count(self.n_drones)
+        # the event of the packets that are not associated to an event, e.g. hello and ack packets
+        self.no_event = Event((-1, -1), -1, self)
+        # recycles the hello and ack packets
+        self.packets_pool = PacketPool(packets_pool)
+
+        self.random_streams = random_streams
+        if self.step_workers > 1 and not (self.synchronous_step
+                                          and self.random_streams == config.RandomStreams.SPAWNED):
+            raise ValueError("step_workers > 1 needs a synchronous step and RandomStreams.SPAWNED")
+        self.__random_streams = {}  # { key : stream }, see random_stream
+        self.__set_random_generators()
+
         # for stats
         self.metrics = Metrics(self)
 
@@ -94,6 +129,10 @@ class Simulator:
         self.__set_simulation()
         self.__set_metrics()
 
+        # the routing phases would be timed from several threads at once
+        if self.step_workers == 1:
+            self.profiler.instrument_routing(self.drones + [self.depot])
+
         self.simulation_name = "out__" + str(self.seed) + "_" + str(self.n_drones) + "_" + str(self.routing_algorithm)
         self.simulation_test_dir = self.simulation_name + "/"
 
@@ -110,7 +149,7 @@ class Simulator:
                 self.stepwise_discovery_mode = True
 
     def __setup_net_dispatcher(self):
-        self.network_dispatcher = MediumDispatcher(self.metrics)
+        self.network_dispatcher = MediumDispatcher(self.metrics, self)
 
     def __set_metrics(self):
         """ the method sets up all the parameters in the metrics class """
@@ -120,17 +159,38 @@ class Simulator:
         if self.seed is not None:
             self.rnd_network = np.random.RandomState(self.seed)
             self.rnd_routing = np.random.RandomState(self.seed)
+            # the choices of rnd_routing, served from batches of draws
+            self.rnd_routing_pool = utilities.RandomPool(self.rnd_routing)
             self.rnd_env = np.random.RandomState(self.seed)
             self.rnd_event = np.random.RandomState(self.seed)
 
+    def random_stream(self, key):
+        """
+        The random draws of a drone or the depot, the same object for the same key.
+        With RandomStreams.SHARED the drones and the depot share the pool of rnd_routing. With
+        RandomStreams.SPAWNED every key has its own generator, spawned from the seed.
+        @param key: the identifier of a drone or "depot"
+        @return: a utilities.RandomPool or utilities.RandomStream
+        """
+        stream = self.__random_streams.get(key)
+        if stream is None:
+            if self.random_streams == config.RandomStreams.SPAWNED:
+                spawn_index = self.n_drones if key == "depot" else key
+                stream = utilities.RandomStream(np.random.SeedSequence(self.seed, spawn_key=(spawn_index,)))
+            else:
+                stream = self.rnd_routing_pool
+            self.__random_streams[key] = stream
+        return stream
+
     def __set_simulation(self):
         """ the method creates all the uav entities """
 
-        self.__set_random_generators()
-
         self.path_manager = utilities.PathManager(config.PATH_FROM_JSON, config.JSONS_PATH_PREFIX, self.seed)
         self.environment = Environment(self.env_width, self.env_height, self)
 
+        # the Q-values of all the drones, shared by their QLearningRouting
+        self.swarm_qtable = SwarmQTable(self.n_drones) if self.routing_algorithm == config.RoutingAlgorithm.QL else None
+
         self.depot = Depot(self.depot_coordinates, self.depot_com_range, self)
 
         self.drones = []
@@ -142,6 +202,17 @@ class Simulator:
         self.environment.add_drones(self.drones)
         self.environment.add_depot(self.depot)
 
+        # the drones positions as a structure of arrays, the drones are moved all at once
+        self.swarm_positions = SwarmPositions(self.drones) if self.vectorized_movement else None
+
+        # distances between the drones and to the depot, shared by all the range queries of a step
+        positions = self.swarm_positions.positions if self.vectorized_movement else None
+        self.distance_matrix = DistanceMatrix(self.drones, self.depot, positions)
+
+        # index of the drones positions, used for all the range queries
+        self.neighbor_grid = NeighborGrid(self.drone_com_range, self.depot, self.distance_matrix)
+        self.neighbor_grid.build(self.drones)
+
         # Set the maximum distance between the drones and the depot
         self.max_dist_drone_depot = utilities.euclidean_distance(self.depot.coords, (self.env_width, self.env_height))
 
@@ -185,75 +256,232 @@ class Simulator:
 
     def increase_meetings_probs(self, drones, cur_step):
         """ Increases the probabilities of meeting someone. """
-        cells = set()
-        for drone in drones:
-            coords = drone.coords
-            cell_index = utilities.TraversedCells.coord_to_cell(size_cell=self.prob_size_cell,
-                                                                width_area=self.env_width,
-                                                                x_pos=coords[0],  # e.g. 1500
-                                                                y_pos=coords[1])  # e.g. 500
-            cells.add(int(cell_index[0]))
+        self.cell_prob_map.update(drones, cur_step)
 
-        for cell, cell_center in utilities.TraversedCells.all_centers(self.env_width, self.env_height,
-                                                                      self.prob_size_cell):
+    def run(self):
+        """
+        Simulator main function
+        @return: None
+        """
 
-            index_cell = int(cell[0])
-            old_vals = self.cell_prob_map[index_cell]
+        profiler = self.profiler
+        progress = tqdm(total=self.len_simulation)
 
-            if index_cell in cells:
-                old_vals[0] += 1
+        cur_step = 0
+        while cur_step < self.len_simulation:
 
-            old_vals[1] = cur_step + 1
-            old_vals[2] = old_vals[0] / max(1, old_vals[1])
-            self.cell_prob_map[index_cell] = old_vals
+            self.__begin_step(cur_step)
+            self.__step(cur_step)
+            self.__end_step(cur_step)
+            cur_step += 1
 
-    def run(self):
+            if self.event_driven:
+                # the steps before the wake step only move the drones
+                with profiler.phase("schedule"):
+                    next_wake_step = min(self.__next_wake_step(cur_step - 1), self.len_simulation)
+                with profiler.phase("movement"):
+                    cur_step = self.__idle_steps(cur_step, next_wake_step)
+
+            progress.update(cur_step - progress.n)
+
+        progress.close()
+        profiler.end_run()
+
+        if self.__step_executor is not None:
+            self.__step_executor.shutdown()
+            self.__step_executor = None
+
+        if config.DEBUG:
+            print("End of simulation, sim time: " + str(
+                cur_step * self.time_step_duration) + " sec, #iteration: " + str(cur_step))
+
+    def __begin_step(self, cur_step):
+        """ what is done at the beginning of every step, complete or idle """
+        if config.DEBUG:
+            print(f"[INFO] Step attuale {cur_step}")
+
+        self.cur_step = cur_step
+        self.profiler.begin_step(cur_step)
+
+    def __end_step(self, cur_step):
+        """ what is done at the end of every step, complete or idle """
+        profiler = self.profiler
+
+        # in case we need probability map
+        if config.ENABLE_PROBABILITIES:
+            with profiler.phase("meetings_probs"):
+                self.increase_meetings_probs(self.drones, cur_step)
+
+        if self.show_plot or config.SAVE_PLOT:
+            with profiler.phase("plot"):
+                self.__plot(cur_step)
+
+        profiler.end_step(cur_step)
+
+    def __step(self, cur_step):
         """
-        Simulator main function
+        A complete step of the simulation: medium, events, update_packets, routing and movement of the drones,
+        then the depot
+        @param cur_step: the current step
         @return: None
         """
+        profiler = self.profiler
 
-        for cur_step in tqdm(range(self.len_simulation)):
-
-            if config.DEBUG:
-                print(f"[INFO] Step attuale {cur_step}")
-                        
-            self.cur_step = cur_step
-            # check for new events and remove the expired ones from the environment
-            # self.environment.update_events(cur_step)
-            # sense the area and move drones and sense the area
+        # check for new events and remove the expired ones from the environment
+        # self.environment.update_events(cur_step)
+        # sense the area and move drones and sense the area
+        with profiler.phase("medium"):
             self.network_dispatcher.run_medium(cur_step)
 
-            # generates events
-            # sense the events
+        # generates events
+        # sense the events
+        with profiler.phase("events"):
             self.event_generator.handle_events_generation(cur_step, self.drones)
 
+        if self.synchronous_step:
+            self.__synchronous_drones_step(cur_step)
+
+        else:
             for drone in self.drones:
                 # 1. update expired packets on drone buffers
                 # 2. try routing packets vs other drones or depot
                 # 3. actually move the drone towards next waypoint or depot
 
-                drone.update_packets(cur_step)
-                drone.routing(self.drones, self.depot, cur_step)
-                drone.move(self.time_step_duration)
+                with profiler.phase("update_packets"):
+                    drone.update_packets(cur_step)
+                with profiler.phase("routing"):
+                    drone.routing(self.drones, self.depot, cur_step)
+
+                if not self.vectorized_movement:
+                    with profiler.phase("movement"):
+                        self.__move_drone(drone)
 
-            # if the stepwise_discovery_mode is enabled
-            if self.stepwise_discovery_mode:
+        # all the drones routed on the positions at the beginning of the step, now they move together
+        if self.vectorized_movement:
+            with profiler.phase("movement"):
+                self.__move_drones()
+
+        # if the stepwise_discovery_mode is enabled
+        if self.stepwise_discovery_mode:
+            with profiler.phase("depot"):
                 # remove expired packets
                 self.depot.update_packets(cur_step)
                 # do the ad-hoc routing
                 self.depot.routing(self.drones, self.depot, cur_step)
-                
-            # in case we need probability map
-            if config.ENABLE_PROBABILITIES:
-                self.increase_meetings_probs(self.drones, cur_step)
 
-            if self.show_plot or config.SAVE_PLOT:
-                self.__plot(cur_step)
+    def __move_drone(self, drone):
+        """ move a single drone and update the structures that index the positions """
+        drone.move(self.time_step_duration)
+        self.neighbor_grid.update(drone)
+        self.distance_matrix.invalidate(drone)
+
+    def __move_drones(self):
+        """ move all the drones, at once when the movement is vectorized """
+        if self.vectorized_movement:
+            self.swarm_positions.move(self.time_step_duration)
+            self.neighbor_grid.build(self.drones)
+            self.distance_matrix.invalidate()
+        else:
+            for drone in self.drones:
+                self.__move_drone(drone)
 
-        if config.DEBUG:
-            print("End of simulation, sim time: " + str(
-                (cur_step + 1) * self.time_step_duration) + " sec, #iteration: " + str(cur_step + 1))
+    def __idle_steps(self, first_step, wake_step):
+        """
+        The steps from first_step up to wake_step, excluded, in which nothing happens but the movement of the
+        drones: only the positions move, the grid and the distances are brought up to date once at the end.
+        A drone with packets entering the range of the depot ends the idle steps earlier.
+        @param first_step: the first step after the last complete one
+        @param wake_step: the next step that must be simulated completely, see __next_wake_step
+        @return: the first step that must be simulated completely
+        """
+        cur_step = first_step
+        while cur_step < wake_step and not self.__buffered_drone_near_depot():
+            self.__begin_step(cur_step)
+            if self.vectorized_movement:
+                self.swarm_positions.move(self.time_step_duration)
+            else:
+                for drone in self.drones:
+                    drone.move(self.time_step_duration)
+            self.__end_step(cur_step)
+            cur_step += 1
+
+        if cur_step > first_step:
+            self.neighbor_grid.build(self.drones)
+            self.distance_matrix.invalidate()
+        return cur_step
+
+    def __next_wake_step(self, cur_step):
+        """
+        The first step after cur_step in which something else than the movement of the drones may happen: a hello,
+        a new event, a retransmission, a delivery of the medium or an expiration of a packet. Before it, only a
+        drone with packets entering the range of the depot wakes the simulation up, see __buffered_drone_near_depot.
+        The wake steps are not kept in a queue, all the drones are scanned after every complete step.
+        @param cur_step: the complete step just simulated
+        @return: the step
+        """
+        def next_multiple(delay):
+            return (cur_step // delay + 1) * delay
+
+        wake_steps = [next_multiple(config.HELLO_DELAY),
+                      next_multiple(self.event_generation_delay),
+                      self.network_dispatcher.next_delivery_step()]
+
+        if self.stepwise_discovery_mode:
+            wake_steps.append(next_multiple(self.dp_event_generation_delay))
+
+        self.__buffered_drones = [drone for drone in self.drones if drone.buffer_length() > 0]
+        if self.__buffered_drones:
+            wake_steps.append(next_multiple(self.drone_retransmission_delta))
+
+        wake_steps.extend(drone.next_update_step(cur_step) for drone in self.drones)
+        return min(wake_steps)
+
+    def __buffered_drone_near_depot(self):
+        """ whether a drone with packets is in the range of the depot, it would offload them in this step.
+            The distances are computed from the positions, the grid is not up to date during the idle steps.
+        """
+        return any(utilities.euclidean_distance(self.depot.coords, drone.coords) <= self.depot.communication_range
+                   for drone in self.__buffered_drones)
+
+    def __synchronous_drones_step(self, cur_step):
+        """
+        The drones update their packets and route on the state at the beginning of the step: the changes to the
+        state shared with the other drones (medium, depot, qtable, metrics) are postponed and then applied drone
+        by drone, in the order of the drones. The drones move after all of them routed.
+        With step_workers > 1 the drones decide in parallel, on threads.
+        @param cur_step: the current step
+        @return: None
+        """
+        profiler = self.profiler
+
+        with profiler.phase("decide"):
+            # all the drones read the distances, they must not be refreshed while they decide
+            self.distance_matrix.refresh()
+            for drone in self.drones:
+                drone.routing_algorithm.pending_effects = []
+
+            if self.step_workers == 1:
+                self.__decide_drones(self.drones, cur_step)
+            else:
+                if self.__step_executor is None:
+                    self.__step_executor = ThreadPoolExecutor(max_workers=self.step_workers)
+                drone_groups = [self.drones[worker::self.step_workers] for worker in range(self.step_workers)]
+                # wait for all the groups, and raise the exception of any of them
+                list(self.__step_executor.map(self.__decide_drones, drone_groups, [cur_step] * len(drone_groups)))
+
+        with profiler.phase("commit"):
+            for drone in self.drones:
+                drone.routing_algorithm.commit_effects()
+
+        if not self.vectorized_movement:
+            with profiler.phase("movement"):
+                self.__move_drones()
+
+    def __decide_drones(self, drones, cur_step):
+        """ the decisions of some drones in a synchronous step """
+        for drone in drones:
+            drone.update_packets(cur_step)
+            drone.routing(self.drones, self.depot, cur_step)
 
     def close(self):
         """ do some stuff at the end of simulation"""
@@ -265,9 +493,12 @@ class Simulator:
     def print_metrics(self, plot_id="final"):
         """ add signature """
         self.metrics.print_overall_stats()
+        if self.profiler.enabled:
+            self.profiler.print_summary()
 
     def save_metrics(self, filename_path, save_pickle=False):
         """ add signature """
         self.metrics.save_as_json(filename_path + ".json")
+        self.profiler.save(filename_path)
         if save_pickle:
             self.metrics.save(filename_path + ".pickle")
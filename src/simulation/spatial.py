@@ -0,0 +1,277 @@
+from src.utilities import utilities as util
+from collections import defaultdict
+
+import numpy as np
+import math
+
+"""
+This file contains the spatial structures owned by the Simulator, they keep track of where the drones are
+so that range queries do not need to compute the distance between every pair of drones.
+"""
+
+
+class NeighborGrid:
+    """ Uniform grid over the area, the cells are as wide as the drones communication range.
+        A range query only looks at the drones in the cells around the queried position.
+    """
+
+    def __init__(self, cell_size, depot, distances):
+        self.cell_size = cell_size
+        self.depot = depot
+        self.distances = distances  # the DistanceMatrix of the simulation
+
+        self.cells = defaultdict(list)  # { (x_cell, y_cell) : drones in the cell }
+        self.drone_cell = {}  # { drone_id : (x_cell, y_cell) }
+
+    def cell_of(self, coords):
+        """ return the (x, y) index of the cell in which coords lay """
+        return int(coords[0] // self.cell_size), int(coords[1] // self.cell_size)
+
+    def build(self, drones):
+        """ index all the drones from scratch """
+        self.cells = defaultdict(list)
+        self.drone_cell = {}
+        for drone in drones:
+            cell = self.cell_of(drone.coords)
+            self.cells[cell].append(drone)
+            self.drone_cell[drone.identifier] = cell
+
+    def update(self, drone):
+        """ move the drone in its new cell, to call every time the drone changes position """
+        new_cell = self.cell_of(drone.coords)
+        old_cell = self.drone_cell.get(drone.identifier)
+        if old_cell == new_cell:
+            return
+
+        if old_cell is not None:
+            self.cells[old_cell].remove(drone)
+            if len(self.cells[old_cell]) == 0:
+                del self.cells[old_cell]
+
+        self.cells[new_cell].append(drone)
+        self.drone_cell[drone.identifier] = new_cell
+
+    def drones_in_range(self, entity, communication_range):
+        """
+        @param entity: a drone or the depot
+        @param communication_range: the radius of the query
+        @return: a list of (drone, distance) for all the drones but entity within communication_range
+            from entity, ordered by drone identifier
+        """
+        x_cell, y_cell = self.cell_of(entity.coords)
+        reach = math.ceil(communication_range / self.cell_size)
+
+        in_range = []
+        for x in range(x_cell - reach, x_cell + reach + 1):
+            for y in range(y_cell - reach, y_cell + reach + 1):
+                for drone in self.cells.get((x, y), ()):
+                    if drone.identifier == entity.identifier:
+                        continue
+
+                    distance = self.distances.distance(entity, drone)
+                    if distance <= communication_range:
+                        in_range.append((drone, distance))
+
+        in_range.sort(key=lambda drone_distance: drone_distance[0].identifier)
+        return in_range
+
+    def distance_in_range(self, src, dst, communication_range):
+        """ return the distance between src and dst if it is at most communication_range, None otherwise.
+            Entities whose cells are too far apart are discarded without computing the distance.
+        """
+        reach = math.ceil(communication_range / self.cell_size)
+        src_cell = self.__indexed_cell(src)
+        dst_cell = self.__indexed_cell(dst)
+        if abs(src_cell[0] - dst_cell[0]) > reach or abs(src_cell[1] - dst_cell[1]) > reach:
+            return None
+
+        distance = self.distances.distance(src, dst)
+        return distance if distance <= communication_range else None
+
+    def in_depot_range(self, entity):
+        """ return True if the entity is within the communication range of the depot """
+        return self.distance_in_range(entity, self.depot, self.depot.communication_range) is not None
+
+    def __indexed_cell(self, entity):
+        """ the cell of an indexed drone, computed on the fly for the depot """
+        cell = self.drone_cell.get(entity.identifier)
+        return cell if cell is not None else self.cell_of(entity.coords)
+
+
+class SwarmPositions:
+    """ Structure of arrays with the positions, the targets and the speeds of all the drones.
+        The drones read and write their coords through their row of the positions array, and they are
+        all moved with a single vectorized interpolation step.
+    """
+
+    def __init__(self, drones):
+        self.drones = drones
+        self.positions = np.zeros((len(drones), 2), dtype=float)
+        self.targets = np.zeros((len(drones), 2), dtype=float)
+        self.speeds = np.array([drone.speed for drone in drones], dtype=float)
+        self.to_depot = np.zeros(len(drones), dtype=bool)
+
+        for drone in drones:
+            drone.attach_position_row(self.positions[drone.identifier])
+
+    def move(self, time):
+        """ move all the drones towards their next target, as Drone.move does for a single drone
+            time -> time_step_duration (how much time between two simulation frame)
+        """
+        targets = [drone.begin_vectorized_move() for drone in self.drones]
+        self.targets[:] = targets
+        self.to_depot[:] = [drone.move_routing for drone in self.drones]
+
+        # same operations of utilities.euclidean_distance, to get the very same positions
+        delta = self.positions - self.targets
+        all_distance = np.power(delta[:, 0] ** 2 + delta[:, 1] ** 2, 0.5)
+        distance = time * self.speeds
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = distance / all_distance
+
+        arrived = (all_distance == 0) | (t >= 1) | ((distance == 0) & ~self.to_depot)
+        moving = ~arrived
+
+        t_moving = t[moving][:, None]
+        self.positions[moving] = (1 - t_moving) * self.positions[moving] + t_moving * self.targets[moving]
+
+        for index in np.flatnonzero(arrived):
+            self.drones[index].end_vectorized_move(targets[index], all_distance[index])
+
+
+def euclidean_distances(points, others):
+    """ the matrix of the distances between every row of points and every row of others, computed with
+        the same operations of utilities.euclidean_distance so that the values are exactly the same
+    """
+    delta_x = points[:, None, 0] - others[None, :, 0]
+    delta_y = points[:, None, 1] - others[None, :, 1]
+    return np.power(delta_x ** 2 + delta_y ** 2, 0.5)
+
+
+class DistanceMatrix:
+    """ The distances between all the drones and from every drone to the depot. They are computed once
+        and reused until the drones move: moving a single drone only invalidates its row and column,
+        the vectorized movement invalidates the whole matrix. The distance from the depot of a single drone
+        is refreshed on its own, without refreshing the rest of the matrix.
+    """
+
+    def __init__(self, drones, depot, positions=None):
+        """
+        @param drones: the drones of the simulation, drone i is the row i of the matrix
+        @param depot: the depot of the simulation
+        @param positions: the (n_drones, 2) positions array when the movement is vectorized, otherwise the
+            matrix keeps its own copy of the positions, updated by invalidate
+        """
+        self.drones = drones
+        self.depot = depot
+        self.depot_coords = np.array([depot.coords], dtype=float)
+
+        self.shared_positions = positions is not None
+        self.positions = positions if self.shared_positions else np.array([d.coords for d in drones], dtype=float)
+
+        self.matrix = np.zeros((len(drones), len(drones)), dtype=float)
+        self.depot_distances = np.zeros(len(drones), dtype=float)
+
+        self.__all_dirty = True
+        self.__dirty_rows = set()
+        self.__dirty_depot = set()
+
+    def invalidate(self, drone=None):
+        """ to call after drone moved, or after all the drones moved if drone is None """
+        if drone is None:
+            if not self.shared_positions:
+                self.positions[:] = [d.coords for d in self.drones]
+            self.__all_dirty = True
+        else:
+            if not self.shared_positions:
+                self.positions[drone.identifier] = drone.coords
+            self.__dirty_rows.add(drone.identifier)
+            self.__dirty_depot.add(drone.identifier)
+
+    def refresh(self):
+        """ recompute the distances invalidated since the last refresh """
+        if self.__all_dirty:
+            self.matrix = euclidean_distances(self.positions, self.positions)
+            self.depot_distances = euclidean_distances(self.depot_coords, self.positions)[0]
+            self.__all_dirty = False
+            self.__dirty_rows.clear()
+            self.__dirty_depot.clear()
+
+        elif self.__dirty_rows:
+            rows = np.fromiter(self.__dirty_rows, dtype=int, count=len(self.__dirty_rows))
+            rows_distances = euclidean_distances(self.positions[rows], self.positions)
+            self.matrix[rows, :] = rows_distances
+            self.matrix[:, rows] = rows_distances.T
+            self.depot_distances[rows] = euclidean_distances(self.depot_coords, self.positions[rows])[0]
+            self.__dirty_rows.clear()
+            self.__dirty_depot.clear()
+
+    def distance(self, entity, other):
+        """ the distance between two drones, or between a drone and the depot """
+        if entity is self.depot:
+            return self.depot_distance(other)
+        if other is self.depot:
+            return self.depot_distance(entity)
+
+        if self.__all_dirty or self.__dirty_rows:
+            self.refresh()
+        return self.matrix[entity.identifier, other.identifier]
+
+    def depot_distance(self, drone):
+        """ the distance between the drone and the depot """
+        if self.__all_dirty:
+            self.refresh()
+
+        if drone.identifier in self.__dirty_depot:
+            self.depot_distances[drone.identifier] = util.euclidean_distance(self.depot.coords, drone.coords)
+            self.__dirty_depot.discard(drone.identifier)
+
+        return self.depot_distances[drone.identifier]
+
+    def drones_matrix(self):
+        """ the (n_drones, n_drones) matrix of the distances between all the drones """
+        if self.__all_dirty or self.__dirty_rows:
+            self.refresh()
+        return self.matrix
+
+
+class CellProbabilityMap:
+    """ How often the drones visited every cell of the area. The cells are numbered as in
+        utilities.TraversedCells, the visits are counted in an array and the probability of a cell,
+        visits / steps, is computed when it is read.
+    """
+
+    def __init__(self, width, height, size_cell):
+        self.size_cell = size_cell
+        self.x_cells = math.ceil(width / size_cell)
+        self.n_cells = self.x_cells * math.ceil(height / size_cell)
+
+        self.counts = np.zeros(self.n_cells, dtype=int)  # steps in which at least a drone was in the cell
+        self.steps = 0  # steps counted so far
+
+        # [(cell number, center of the cell)], computed once for the drawing
+        self.centers = [(int(cell[0]), center) for cell, center in util.TraversedCells.all_centers(width, height,
+                                                                                                   size_cell)]
+
+    def cell_of(self, coords):
+        """ the number of the cell in which coords lay """
+        return int(coords[0] / self.size_cell) + self.x_cells * int(coords[1] / self.size_cell)
+
+    def update(self, drones, cur_step):
+        """ count a visit to every cell with at least a drone in it """
+        cells = {self.cell_of(drone.coords) for drone in drones}
+        cells = [cell for cell in cells if 0 <= cell < self.n_cells]
+        self.counts[cells] += 1
+        self.steps = cur_step + 1
+
+    def probability(self, cell):
+        """ the fraction of the steps in which at least a drone was in the cell """
+        if not 0 <= cell < self.n_cells:
+            return 0
+        return self.counts[cell] / max(1, self.steps)
+
+    def __getitem__(self, cell):
+        """ [visits, steps, probability] of the cell """
+        count = self.counts[cell] if 0 <= cell < self.n_cells else 0
+        return [count, self.steps, self.probability(cell)]
@@ -0,0 +1,37 @@
+from src.utilities import config
+from src.simulation.simulator import Simulator
+
+import pytest
+
+"""
+The regression checks of the alternative engines: every mode of the simulator is run on a small seeded
+scenario and its metrics json, and Q-tables where they exist, must be the same as the default engine ones.
+
+    python -m pytest src/tests
+"""
+
+N_STEPS = 3000
+N_DRONES = 10
+SEED = 4
+
+
+@pytest.fixture
+def run_simulation(tmp_path, monkeypatch):
+    """
+    The function that runs a seeded simulation, the keyword arguments are passed to Simulator.
+    It returns the metrics json, as saved by Metrics.save_as_json, and the simulator.
+    Tours are generated from the seed, the tours json has too few drones.
+    """
+    monkeypatch.setattr(config, "PATH_FROM_JSON", False)
+    runs = iter(range(10 ** 6))
+
+    def run(**kwargs):
+        kwargs = {"len_simulation": N_STEPS, "n_drones": N_DRONES, "seed": SEED, "show_plot": False, **kwargs}
+        simulation = Simulator(**kwargs)
+        simulation.run()
+
+        json_path = tmp_path / ("metrics_" + str(next(runs)) + ".json")
+        simulation.metrics.save_as_json(json_path)
+        return json_path.read_text(), simulation
+
+    return run
@@ -0,0 +1,40 @@
+from src.utilities import config
+from src.entities.uav_entities import Drone, Depot
+
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize("routing_algorithm", [config.RoutingAlgorithm.QL, config.RoutingAlgorithm.GEO])
+def test_update_packets_removes_exactly_the_expired_packets(run_simulation, monkeypatch, routing_algorithm):
+    """ after update_packets the buffer is the old one without the expired packets, in the same order, and the
+        tightest deadline of a drone is the one of its buffer
+    """
+    expired = {Drone: 0, Depot: 0}
+
+    def checked(entity_class):
+        update_packets = entity_class.update_packets
+
+        def checked_update_packets(entity, cur_step):
+            packets = entity.all_packets()
+            alive_packets = [pck for pck in packets if not pck.is_expired(cur_step)]
+
+            update_packets(entity, cur_step)
+
+            assert entity.all_packets() == alive_packets
+            expired[entity_class] += len(packets) - len(alive_packets)
+            if entity_class is Drone:
+                tightest_deadline = min((pck.event_ref.deadline for pck in alive_packets), default=np.nan)
+                np.testing.assert_equal(entity.tightest_event_deadline, tightest_deadline)
+
+        return checked_update_packets
+
+    monkeypatch.setattr(Drone, "update_packets", checked(Drone))
+    monkeypatch.setattr(Depot, "update_packets", checked(Depot))
+
+    run_simulation(routing_algorithm=routing_algorithm, event_duration=150, dp_event_duration=150)
+
+    # the scenario must expire packets for the check to mean something
+    assert expired[Drone] > 0
+    if routing_algorithm == config.RoutingAlgorithm.QL:
+        assert expired[Depot] > 0
@@ -0,0 +1,23 @@
+from src.utilities import config
+
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize("hello_delay, kwargs", [
+    (5, {}),
+    (40, {"routing_algorithm": config.RoutingAlgorithm.RND, "event_generation_delay": 200}),
+    (40, {"routing_algorithm": config.RoutingAlgorithm.GEO, "vectorized_movement": True}),
+    (100, {"event_generation_delay": 1000, "drone_retransmission_delta": 50}),
+])
+def test_event_driven_matches_step_by_step(run_simulation, monkeypatch, hello_delay, kwargs):
+    """ the idle steps only move the drones, the metrics, the Q-tables and the positions must not change """
+    monkeypatch.setattr(config, "HELLO_DELAY", hello_delay)
+
+    step_json, step_simulation = run_simulation(event_driven=False, **kwargs)
+    event_json, event_simulation = run_simulation(event_driven=True, **kwargs)
+
+    assert event_json == step_json
+    assert [drone.coords for drone in event_simulation.drones] == [drone.coords for drone in step_simulation.drones]
+    if step_simulation.swarm_qtable is not None:
+        assert np.array_equal(event_simulation.swarm_qtable.q, step_simulation.swarm_qtable.q)
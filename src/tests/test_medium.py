@@ -0,0 +1,10 @@
+from src.utilities import config
+
+import pytest
+
+
+def test_packets_due_in_a_delivered_step_are_refused(run_simulation, monkeypatch):
+    """ with no transmission delay the packets would be due in the step the medium already ran """
+    monkeypatch.setattr(config, "LIL_DELTA", 0)
+    with pytest.raises(AssertionError):
+        run_simulation(len_simulation=50)
@@ -0,0 +1,67 @@
+from src.utilities import config
+from src.entities.uav_entities import HelloPacket
+
+from collections import Counter
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize("routing_algorithm", [config.RoutingAlgorithm.QL, config.RoutingAlgorithm.RND])
+def test_packets_pool_matches_new_packets(run_simulation, routing_algorithm):
+    """ recycling the hello and ack packets must not change the metrics nor the Q-tables """
+    pool_json, pool_simulation = run_simulation(routing_algorithm=routing_algorithm, packets_pool=True)
+    new_json, new_simulation = run_simulation(routing_algorithm=routing_algorithm, packets_pool=False)
+
+    assert pool_json == new_json
+    if routing_algorithm == config.RoutingAlgorithm.QL:
+        np.testing.assert_array_equal(pool_simulation.swarm_qtable.q, new_simulation.swarm_qtable.q)
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"synchronous_step": True, "step_workers": 4,
+                                         "random_streams": config.RandomStreams.SPAWNED}])
+def test_holders_count_the_references(run_simulation, kwargs):
+    """ at the end of a seeded run, every pooled packet is held once by the medium for each of its entries and
+        once by every drone that keeps it as hello, the released ones are held by nobody. Also when the drones
+        decide on threads.
+    """
+    _, simulation = run_simulation(packets_pool=True, **kwargs)
+    packets_pool = simulation.packets_pool
+
+    references = Counter()
+    for bucket in simulation.network_dispatcher.packets.values():
+        references.update(id(packet) for packet, _, _, _ in bucket if packet.__class__ in packets_pool.free)
+    for drone in simulation.drones:
+        references.update(id(hello) for hello in drone.routing_algorithm.hello_messages.values())
+
+    held_packets = {id(packet): packet for bucket in simulation.network_dispatcher.packets.values()
+                    for packet, _, _, _ in bucket}
+    held_packets.update({id(hello): hello for drone in simulation.drones
+                         for hello in drone.routing_algorithm.hello_messages.values()})
+    assert len(references) > 0
+    for packet_id, n_references in references.items():
+        assert held_packets[packet_id].holders == n_references
+
+    for released_packets in packets_pool.free.values():
+        for packet in released_packets:
+            assert packet.holders == 0
+            assert id(packet) not in references
+
+    # no packet is lost: it is either held or back in the pool
+    for packet_class, released_packets in packets_pool.free.items():
+        n_held = sum(1 for packet in held_packets.values() if packet.__class__ is packet_class)
+        assert packets_pool.allocated[packet_class] == n_held + len(released_packets)
+
+
+def test_release_more_times_than_held(run_simulation):
+    """ a second release of the same reference must not recycle the packet again """
+    _, simulation = run_simulation(len_simulation=10)
+    packets_pool = simulation.packets_pool
+    drone = simulation.drones[0]
+
+    hello = packets_pool.acquire(HelloPacket, drone, 10, simulation, drone.coords, drone.speed, drone.next_target())
+    packets_pool.hold(hello)
+    packets_pool.release(hello)
+    assert packets_pool.free[HelloPacket][-1] is hello
+
+    with pytest.raises(AssertionError):
+        packets_pool.release(hello)
@@ -0,0 +1,22 @@
+from src.utilities import config
+from src.utilities.utilities import RandomPool
+
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize("batch_size", [1, 7, 4096])
+def test_choices_match_the_generator(batch_size):
+    """ the pool must return the choices of RandomState.choice, in the same order, whatever the batch size """
+    sizes = np.random.RandomState(0).randint(1, 70, size=5000).tolist()
+    rnd = np.random.RandomState(config.SEED)
+    random_pool = RandomPool(np.random.RandomState(config.SEED), batch_size)
+
+    for size in sizes:
+        population = list(range(size))
+        assert random_pool.choice(population) == rnd.choice(population)
+
+
+def test_empty_choice():
+    with pytest.raises(ValueError):
+        RandomPool(np.random.RandomState(config.SEED)).choice([])
@@ -0,0 +1,18 @@
+from src.utilities import config
+
+import pytest
+
+
+@pytest.mark.parametrize("routing_algorithm", [config.RoutingAlgorithm.QL, config.RoutingAlgorithm.GEO,
+                                               config.RoutingAlgorithm.RND])
+@pytest.mark.parametrize("event_duration", [config.EVENTS_DURATION, 150])
+def test_streaming_metrics_match_live_objects(run_simulation, routing_algorithm, event_duration):
+    """ the rows of the streaming metrics must be saved as the default mode saves its objects, in the same
+        order, also when the packets expire
+    """
+    kwargs = {"routing_algorithm": routing_algorithm, "event_duration": event_duration,
+              "dp_event_duration": event_duration}
+    live_json, _ = run_simulation(streaming_metrics=False, **kwargs)
+    streaming_json, _ = run_simulation(streaming_metrics=True, **kwargs)
+
+    assert streaming_json == live_json
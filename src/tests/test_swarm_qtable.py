@@ -0,0 +1,55 @@
+from src.utilities import config
+from src.routing_algorithms.q_learning_routing import SwarmQTable, LEARNING_RATE, DISCOUNT_FACTOR
+
+import numpy as np
+import pytest
+
+
+def one_update_at_a_time(q, states, actions, rewards):
+    """ the Bellman updates applied one by one, in order, as the per-drone feedback did """
+    q = q.copy()
+    for state, action, reward in zip(states, actions, rewards):
+        q[state, action] = (1 - LEARNING_RATE) * q[state, action] + \
+            LEARNING_RATE * (reward + (DISCOUNT_FACTOR * max(q[action])))
+    return q
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_bellman_update_matches_one_update_at_a_time(seed):
+    """ the rounds of bellman_update give the same Q-values of the sequential updates, also when the relay
+        of a drone updates its own row before or after it
+    """
+    rnd = np.random.RandomState(seed)
+    n_drones = 12
+    swarm_qtable = SwarmQTable(n_drones, capacity=4)  # small, to grow while taking the actions
+    swarm_qtable.q[:] = rnd.uniform(-1, 1, (n_drones, n_drones))
+
+    states = sorted(rnd.choice(n_drones, size=rnd.randint(1, n_drones + 1), replace=False).tolist())
+    for state in reversed(states):
+        action = rnd.choice([drone for drone in range(n_drones) if drone != state])
+        swarm_qtable.take_action(None, 0, state, action, 3, 8., (0., 0.))
+
+    slots = swarm_qtable.slots_of(0)
+    assert swarm_qtable.states[slots].tolist() == states
+
+    rewards = rnd.uniform(-1, 1, len(slots)).tolist()
+    expected_q = one_update_at_a_time(swarm_qtable.q, states, swarm_qtable.actions[slots].tolist(), rewards)
+
+    swarm_qtable.bellman_update(slots, rewards)
+    np.testing.assert_array_equal(swarm_qtable.q, expected_q)
+
+    swarm_qtable.release(0, slots)
+    assert 0 not in swarm_qtable.event_slots
+    assert len(swarm_qtable.free_slots) == len(swarm_qtable.states)
+
+
+def test_batch_feedback_releases_all_the_actions(run_simulation):
+    """ at the end of a seeded run, the slots still taken are exactly the actions waiting for a feedback """
+    _, simulation = run_simulation(routing_algorithm=config.RoutingAlgorithm.QL)
+    swarm_qtable = simulation.swarm_qtable
+
+    taken_slots = sorted(slot for drone in simulation.drones
+                         for slot in drone.routing_algorithm.taken_actions.values())
+    event_slots = sorted(slot for slots in swarm_qtable.event_slots.values() for slot in slots)
+    assert taken_slots == event_slots
+    assert len(taken_slots) + len(swarm_qtable.free_slots) == len(swarm_qtable.states)
@@ -0,0 +1,41 @@
+from src.utilities import config
+from src.simulation.simulator import Simulator
+
+import numpy as np
+import pytest
+
+SYNCHRONOUS = {"synchronous_step": True, "random_streams": config.RandomStreams.SPAWNED}
+
+
+@pytest.mark.parametrize("routing_algorithm", [config.RoutingAlgorithm.QL, config.RoutingAlgorithm.RND])
+def test_threaded_matches_sequential(run_simulation, routing_algorithm):
+    """ the drones deciding on threads must give the metrics and the Q-tables of the sequential decisions """
+    sequential_json, sequential_simulation = run_simulation(routing_algorithm=routing_algorithm, step_workers=1,
+                                                            **SYNCHRONOUS)
+    threaded_json, threaded_simulation = run_simulation(routing_algorithm=routing_algorithm, step_workers=4,
+                                                        **SYNCHRONOUS)
+
+    assert threaded_json == sequential_json
+    if routing_algorithm == config.RoutingAlgorithm.QL:
+        np.testing.assert_array_equal(threaded_simulation.swarm_qtable.q, sequential_simulation.swarm_qtable.q)
+
+
+def test_decisions_do_not_depend_on_the_order(run_simulation, monkeypatch):
+    """ the effects are committed in the order of the drones, whatever the order in which they decided """
+    sequential_json, sequential_simulation = run_simulation(**SYNCHRONOUS)
+
+    decide_drones = Simulator._Simulator__decide_drones
+    monkeypatch.setattr(Simulator, "_Simulator__decide_drones",
+                        lambda simulation, drones, cur_step: decide_drones(simulation, drones[::-1], cur_step))
+    reversed_json, reversed_simulation = run_simulation(**SYNCHRONOUS)
+
+    assert reversed_json == sequential_json
+    np.testing.assert_array_equal(reversed_simulation.swarm_qtable.q, sequential_simulation.swarm_qtable.q)
+
+
+@pytest.mark.parametrize("kwargs", [{"synchronous_step": False, "random_streams": config.RandomStreams.SPAWNED},
+                                    {"synchronous_step": True, "random_streams": config.RandomStreams.SHARED}])
+def test_workers_need_synchronous_spawned_step(monkeypatch, kwargs):
+    monkeypatch.setattr(config, "PATH_FROM_JSON", False)
+    with pytest.raises(ValueError):
+        Simulator(len_simulation=10, n_drones=5, show_plot=False, step_workers=2, **kwargs)
@@ -49,6 +49,10 @@ IS_SHOW_NEXT_TARGET_VEC = True  # bool : whether show the direction and next tar
 SAVE_PLOT = False  # bool: whether to save the plots of the simulation or not.
 SAVE_PLOT_DIR = "data/plots/"
 
+PROFILE_PHASES = False  # bool: whether to accumulate the time spent in every phase of the step and in the routing
+                        # algorithms methods, the summary is saved next to the metrics json.
+PROFILE_CAPTURE_STEPS = None  # None or (int, int): steps [start, end) to capture with cProfile, saved as .pstats
+
 
 # add constants here...
 
@@ -56,6 +60,10 @@ SAVE_PLOT_DIR = "data/plots/"
 SIM_DURATION = 18000   # int: steps of simulation. # ***
 TS_DURATION = 0.150   # float: seconds duration of a step in seconds.
 SEED = 10  # int: seed of this simulation.
+STREAMING_METRICS = False  # bool: whether the metrics record the packets and the events as compact rows, with no
+                           # live objects, instead of keeping the objects alive until the end of the simulation.
+PACKETS_POOL = True  # bool: whether the hello and ack packets are recycled once the medium delivered them and no
+                     # drone holds them anymore, instead of allocating new ones.
 
 N_DRONES = 20    # int: number of drones. # ***
 ENV_WIDTH = 1500      # float: meters, width of environment.
@@ -78,6 +86,16 @@ SENSING_RANGE_DRONE = 0        # float: meters, the sensing range of the drones.
 DRONE_SPEED = 8                  # float: m/s, drone speed.
 DRONE_MAX_BUFFER_SIZE = 10000     # int: max number of packets in the buffer of a drone.
 DRONE_MAX_ENERGY = 1000000           # int: max energy of a drone.
+VECTORIZED_MOVEMENT = False      # bool: whether to keep the drones positions in a numpy array and move them all
+                                    # at once at the end of the step, instead of one by one after their routing.
+SYNCHRONOUS_STEP = False  # bool: whether all the drones decide on the state at the beginning of the step and the
+                          # changes they make to the shared state are applied after, drone by drone.
+STEP_WORKERS = 1  # int: the threads deciding the drones of a synchronous step, more than one needs
+                  # RANDOM_STREAMS = RandomStreams.SPAWNED.
+EVENT_DRIVEN = False  # bool: whether the steps in which nothing is scheduled (no hello, event, retransmission,
+                      # delivery or expiration) only move the drones, instead of running the whole step. It is
+                      # not an event scheduler: every step is still advanced, the idle ones only move the positions,
+                      # and the next wake step is found scanning all the drones after every complete step.
 
 # depot
 DEPOT_COMMUNICATION_RANGE = 150  # float: meters, communication range of the depot.
@@ -103,6 +121,22 @@ class ChannelError(Enum):
     def keylist():
         return list(map(lambda c: c.name, ChannelError))
 
+class BroadcastAccounting(Enum):
+    PER_RECEIVER = 1      # a broadcast counts one control packet for every addressed drone
+    PER_TRANSMISSION = 2  # a broadcast counts a single control packet
+
+    @staticmethod
+    def keylist():
+        return list(map(lambda c: c.name, BroadcastAccounting))
+
+class RandomStreams(Enum):
+    SHARED = 1   # the drones draw from the generators of the simulator, in the order they run (the old streams)
+    SPAWNED = 2  # every drone and the depot draw from their own generator, spawned from the seed
+
+    @staticmethod
+    def keylist():
+        return list(map(lambda c: c.name, RandomStreams))
+
 
 ROUTING_ALGORITHM = RoutingAlgorithm.QL
 CHANNEL_ERROR_TYPE = ChannelError.GAUSSIAN
@@ -111,6 +145,13 @@ CHANNEL_ERROR_TYPE = ChannelError.GAUSSIAN
 # the STEPWISE_NODE_DISCOVERY mode will be enabled
 STEPWISE_NODE_DISCOVERY = True
 
+# how the broadcasts are counted in all_control_packets_in_simulation
+BROADCAST_ACCOUNTING = BroadcastAccounting.PER_RECEIVER
+
+# where the routing of the drones and the depot take their random draws from, SPAWNED makes the draws of a drone
+# independent of the order in which the drones are updated
+RANDOM_STREAMS = RandomStreams.SHARED
+
 COMMUNICATION_P_SUCCESS = 1   # float: probability to have success in a communication.
 GUASSIAN_SCALE = .9            # float [0,1]: scale the error probability of the guassian -> success * GUASSIAN_SCALER
 PACKETS_MAX_TTL = 200         # float: threshold in the maximum number of hops. Causes loss of packets.
@@ -130,6 +171,7 @@ DP_DELAY = 110
 ROOT_EVALUATION_DATA = "data/evaluation_tests/"
 
 NN_MODEL_PATH = "data/nnmodels/"
+BENCHMARKS_DIR = "data/benchmarks/"  # output data : the results of src.benchmarks.benchmark_simulator
 
 # --------------- new cell probabilities -------------- #
 CELL_PROB_SIZE_R = 1.875  # the percentage of cell size with respect to drone com range
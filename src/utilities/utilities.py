@@ -102,6 +102,83 @@ class EventGenerator:
             if cur_step % self.simulator.dp_event_generation_delay == 0: # if it's time to generate a new discovery packet
                 self.simulator.depot.feel_event(cur_step)
 
+# ------------------ Random pool ----------------------
+class RandomPool:
+
+    def __init__(self, rnd, batch_size=4096):
+        """
+        Serves rnd.choice from batches of 32 bits words drawn in advance, with the same rejection sampling of
+        np.random.RandomState.randint, so the choices are the ones rnd.choice would return, in the same order.
+        Once the pool draws from rnd, rnd must not be used in any other way.
+
+        :param rnd: the np.random.RandomState to draw from
+        :param batch_size: the number of words drawn at once
+        """
+        self.rnd = rnd
+        self.batch_size = batch_size
+        self.words = []  # the words of the current batch
+        self.next = 0  # the index of the next word to serve
+
+    def choice(self, a):
+        """ rnd.choice(a) for a non empty list a """
+        n_items = len(a)
+        if n_items == 0:
+            raise ValueError("a cannot be empty unless no samples are taken")
+
+        # the largest index, drawn as a word masked to its bits and rejected while too large
+        last_index = n_items - 1
+        if last_index == 0:
+            return a[0]
+
+        mask = (1 << last_index.bit_length()) - 1
+        while True:
+            if self.next >= len(self.words):
+                self.__draw()
+            index = self.words[self.next] & mask
+            self.next += 1
+            if index <= last_index:
+                return a[index]
+
+    def __draw(self):
+        """ replace the served words with a new batch """
+        self.words = self.rnd.randint(0, 2 ** 32, size=self.batch_size, dtype=np.uint32).tolist()
+        self.next = 0
+
+
+# ------------------ Random stream ----------------------
+class RandomStream:
+
+    def __init__(self, seed_sequence, batch_size=256):
+        """
+        The generator of a single entity, with the random and choice methods of np.random.RandomState.
+        All the values come from the same sequence of uniform draws, so they do not depend on batch_size.
+
+        :param seed_sequence: the np.random.SeedSequence of the entity
+        :param batch_size: the number of values drawn at once
+        """
+        self.rnd = np.random.default_rng(seed_sequence)
+        self.batch_size = batch_size
+        self.values = np.zeros(0)  # the values of the current batch
+        self.next = 0  # the index of the next value to serve
+
+    def random(self):
+        """ the next value in [0, 1) """
+        if self.next >= len(self.values):
+            self.__draw()
+        value = self.values[self.next]
+        self.next += 1
+        return value
+
+    def choice(self, a):
+        """ an element of the list a, picked with the next value """
+        return a[int(self.random() * len(a))]
+
+    def __draw(self):
+        """ replace the served values with a new batch """
+        self.values = self.rnd.random(self.batch_size)
+        self.next = 0
+
+
 # ------------------ Path manager ----------------------
 class PathManager:
 